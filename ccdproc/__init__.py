@@ -17,3 +17,5 @@ if not _ASTROPY_SETUP_:
     from .ccddata import *
     from .combiner import *
     from .image_collection import *
+    from .amplifiers import *
+    from .noise_model import *
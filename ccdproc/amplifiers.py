@@ -0,0 +1,458 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+
+"""This module implements processing of multi-amplifier readouts."""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from astropy.units.quantity import Quantity
+from astropy import units as u
+from astropy.nddata import StdDevUncertainty
+
+from .ccddata import CCDData
+from .core import overscan_estimate
+from .log_meta import log_to_metadata
+from .utils.slices import slice_from_string
+
+__all__ = ['Amplifier', 'AmplifierLayout', 'process_amplifiers']
+
+
+class Amplifier(object):
+    """
+    Readout geometry and electronics of a single amplifier.
+
+    Parameters
+    ----------
+    data_section : str
+        Region of the raw image read out by this amplifier, using the FITS
+        conventions for index order and index start (like ``DATASEC``).
+
+    bias_section : str or None, optional
+        Overscan region of this amplifier in the raw image, in the same
+        convention as ``data_section`` (like ``BIASSEC``). If ``None`` no
+        overscan is subtracted.
+        Default is ``None``.
+
+    detector_section : str or None, optional
+        Region of the assembled image into which the data of this amplifier
+        is written (like ``DETSEC``). Reversed ranges flip the data. If
+        ``None`` the position is derived from the layout of the data
+        sections; see `AmplifierLayout`.
+        Default is ``None``.
+
+    gain : `~astropy.units.Quantity` or None, optional
+        Gain of the amplifier. If ``None`` the data is not gain corrected.
+        Default is ``None``.
+
+    readnoise : `~astropy.units.Quantity` or None, optional
+        Read noise of the amplifier; needed to create the uncertainty.
+        Default is ``None``.
+
+    overscan_axis : 0 or 1, optional
+        Axis along which the overscan is collapsed; see
+        `~ccdproc.subtract_overscan`.
+        Default is ``1``.
+    """
+    def __init__(self, data_section, bias_section=None, detector_section=None,
+                 gain=None, readnoise=None, overscan_axis=1):
+        for name, value in [('gain', gain), ('readnoise', readnoise)]:
+            if not (value is None or isinstance(value, Quantity)):
+                raise TypeError('{} is not None or astropy.units.Quantity.'
+                                ''.format(name))
+        self.data_section = data_section
+        self.bias_section = bias_section
+        self.detector_section = detector_section
+        self.gain = gain
+        self.readnoise = readnoise
+        self.overscan_axis = overscan_axis
+
+    def __repr__(self):
+        return ("{0}(data_section={1!r}, bias_section={2!r}, "
+                "detector_section={3!r}, gain={4!r}, readnoise={5!r})".format(
+                    self.__class__.__name__, self.data_section,
+                    self.bias_section, self.detector_section, self.gain,
+                    self.readnoise))
+
+    @property
+    def data_slice(self):
+        return slice_from_string(self.data_section, fits_convention=True)
+
+    @property
+    def bias_slice(self):
+        if self.bias_section is None:
+            return None
+        return slice_from_string(self.bias_section, fits_convention=True)
+
+
+class AmplifierLayout(object):
+    """
+    Description of how the amplifiers of a detector are read out and how
+    their data is assembled into one image.
+
+    Parameters
+    ----------
+    amplifiers : list of `Amplifier`
+        The amplifiers of the detector.
+
+    Notes
+    -----
+    If no amplifier has a ``detector_section`` the amplifiers are assumed to
+    lie on a grid: the data sections are packed together in the order in
+    which they appear in the raw image, leaving out the overscan regions.
+    Either all or none of the amplifiers must have a ``detector_section``.
+
+    Examples
+    --------
+    Two amplifiers reading out the left and right half of a 200x100 image,
+    each with 10 columns of overscan on the outside::
+
+        >>> from astropy import units as u
+        >>> from ccdproc import Amplifier, AmplifierLayout
+        >>> layout = AmplifierLayout([
+        ...     Amplifier('[11:110,1:100]', '[1:10,1:100]',
+        ...               gain=1.5 * u.electron / u.adu),
+        ...     Amplifier('[111:210,1:100]', '[211:220,1:100]',
+        ...               gain=1.6 * u.electron / u.adu)])
+        >>> layout.shape
+        (100, 200)
+    """
+    def __init__(self, amplifiers):
+        amplifiers = list(amplifiers)
+        if not amplifiers:
+            raise ValueError('a layout needs at least one amplifier.')
+        for amp in amplifiers:
+            if not isinstance(amp, Amplifier):
+                raise TypeError('amplifiers should only contain Amplifier '
+                                'objects.')
+        have_detsec = [amp.detector_section is not None for amp in amplifiers]
+        if any(have_detsec) and not all(have_detsec):
+            raise ValueError('either all or none of the amplifiers must have '
+                             'a detector_section.')
+        self._amplifiers = amplifiers
+
+    def __len__(self):
+        return len(self._amplifiers)
+
+    def __iter__(self):
+        return iter(self._amplifiers)
+
+    def __getitem__(self, index):
+        return self._amplifiers[index]
+
+    @property
+    def amplifiers(self):
+        """
+        list of `Amplifier`, The amplifiers of this layout.
+        """
+        return self._amplifiers
+
+    @property
+    def detector_slices(self):
+        """
+        list of tuple of slices, Position of each amplifier in the assembled
+        image.
+        """
+        if self._amplifiers[0].detector_section is not None:
+            return [slice_from_string(amp.detector_section,
+                                      fits_convention=True)
+                    for amp in self._amplifiers]
+        return self._packed_slices()
+
+    @property
+    def shape(self):
+        """
+        tuple, Shape of the assembled image.
+        """
+        extent = [0, 0]
+        for slices in self.detector_slices:
+            for axis, a_slice in enumerate(slices):
+                if a_slice.step is not None and a_slice.step < 0:
+                    stop = a_slice.start + 1
+                else:
+                    stop = a_slice.stop
+                extent[axis] = max(extent[axis], stop)
+        return tuple(extent)
+
+    def _packed_slices(self):
+        # Each distinct start of the data sections along an axis is one band
+        # of the grid; bands are placed next to each other.
+        data_slices = [amp.data_slice for amp in self._amplifiers]
+        offsets = []
+        for axis in range(2):
+            bands = {}
+            for slices in data_slices:
+                a_slice = slices[axis]
+                bands[a_slice.start] = a_slice.stop - a_slice.start
+            position = 0
+            axis_offsets = {}
+            for start in sorted(bands):
+                axis_offsets[start] = position
+                position += bands[start]
+            offsets.append(axis_offsets)
+
+        packed = []
+        for slices in data_slices:
+            packed.append(tuple(
+                slice(offsets[axis][a_slice.start],
+                      offsets[axis][a_slice.start] +
+                      a_slice.stop - a_slice.start)
+                for axis, a_slice in enumerate(slices)))
+        return packed
+
+    @classmethod
+    def from_header(cls, header, data_key='DATASEC{}', bias_key='BIASSEC{}',
+                    detector_key='DETSEC{}', gain_key='GAIN{}',
+                    readnoise_key='RDNOISE{}',
+                    gain_unit=u.electron / u.adu, readnoise_unit=u.electron):
+        """
+        Create the layout from the numbered section keywords in one header.
+
+        The keywords are looked up with the amplifier number, starting at 1,
+        inserted into the templates (``DATASEC1``, ``DATASEC2``, ...) until no
+        data section is found. If the header has no numbered data section the
+        keywords without number are used for a single amplifier.
+
+        Parameters
+        ----------
+        header : `~astropy.io.fits.Header` or dict-like
+            Header containing the section keywords.
+
+        data_key, bias_key, detector_key, gain_key, readnoise_key : str, \
+                optional
+            Templates of the keywords; ``{}`` is replaced by the amplifier
+            number. Only the data section keyword is required.
+
+        gain_unit, readnoise_unit : `~astropy.units.Unit`, optional
+            Units of the gain and read noise values in the header.
+            Default is ``electron / adu`` and ``electron``.
+
+        Returns
+        -------
+        layout : `AmplifierLayout`
+        """
+        numbers = []
+        number = 1
+        while data_key.format(number) in header:
+            numbers.append(number)
+            number += 1
+        if not numbers:
+            if data_key.format('') not in header:
+                raise KeyError('no data section keyword {} found in header.'
+                               ''.format(data_key.format('')))
+            numbers = ['']
+
+        amplifiers = []
+        for number in numbers:
+            amplifiers.append(cls._amplifier_from_header(
+                header, number, data_key, bias_key, detector_key, gain_key,
+                readnoise_key, gain_unit, readnoise_unit))
+        return cls(amplifiers)
+
+    @classmethod
+    def from_headers(cls, headers, data_key='DATASEC', bias_key='BIASSEC',
+                     detector_key='DETSEC', gain_key='GAIN',
+                     readnoise_key='RDNOISE',
+                     gain_unit=u.electron / u.adu, readnoise_unit=u.electron):
+        """
+        Create the layout from one header per amplifier, for instance from
+        the extensions of a multi-extension FITS file.
+
+        Parameters
+        ----------
+        headers : list of `~astropy.io.fits.Header` or dict-like
+            One header per amplifier.
+
+        data_key, bias_key, detector_key, gain_key, readnoise_key : str, \
+                optional
+            Keywords of the sections, gain and read noise. Only the data
+            section keyword is required.
+
+        gain_unit, readnoise_unit : `~astropy.units.Unit`, optional
+            Units of the gain and read noise values in the headers.
+            Default is ``electron / adu`` and ``electron``.
+
+        Returns
+        -------
+        layout : `AmplifierLayout`
+        """
+        return cls([cls._amplifier_from_header(
+            header, '', data_key, bias_key, detector_key, gain_key,
+            readnoise_key, gain_unit, readnoise_unit) for header in headers])
+
+    @staticmethod
+    def _amplifier_from_header(header, number, data_key, bias_key,
+                               detector_key, gain_key, readnoise_key,
+                               gain_unit, readnoise_unit):
+        def value(template):
+            return header.get(template.format(number))
+
+        data_section = value(data_key)
+        if data_section is None:
+            raise KeyError('no data section keyword {} found in header.'
+                           ''.format(data_key.format(number)))
+        gain = value(gain_key)
+        readnoise = value(readnoise_key)
+        return Amplifier(
+            data_section, bias_section=value(bias_key),
+            detector_section=value(detector_key),
+            gain=None if gain is None else gain * u.Unit(gain_unit),
+            readnoise=(None if readnoise is None else
+                       readnoise * u.Unit(readnoise_unit)))
+
+
+def _process_one_amplifier(raw, raw_mask, amp, detector_slice, output,
+                           deviation, mask, method, method_kwargs):
+    """
+    Overscan subtract, gain correct and (optionally) create the deviation of
+    one amplifier, writing straight into its region of the assembled arrays.
+    """
+    data_slice = amp.data_slice
+    target = output[detector_slice]
+    target[...] = raw[data_slice]
+
+    bias_slice = amp.bias_slice
+    if bias_slice is not None:
+        profile = overscan_estimate(raw[bias_slice],
+                                    overscan_axis=amp.overscan_axis,
+                                    method=method, **method_kwargs)
+        if amp.overscan_axis == 1:
+            profile = profile[:, np.newaxis]
+        else:
+            profile = profile[np.newaxis, :]
+        # target is a view of the output in the orientation of the raw data,
+        # like the profile, even if the detector section is flipped.
+        target -= profile
+
+    if amp.gain is not None:
+        target *= amp.gain.value
+
+    if deviation is not None:
+        # The data is already gain corrected, so it is in the units of the
+        # read noise.
+        np.sqrt(target + amp.readnoise.value ** 2,
+                out=deviation[detector_slice])
+
+    if raw_mask is not None:
+        mask[detector_slice] = raw_mask[data_slice]
+
+
+@log_to_metadata
+def process_amplifiers(ccd, layout, error=False, method='median',
+                       method_kwargs=None, n_threads=1):
+    """
+    Overscan subtract, trim, gain correct and assemble the amplifiers of a
+    multi-amplifier readout in one pass.
+
+    Every amplifier has its own overscan region, gain and read noise, taken
+    from ``layout``. The corrected data of each amplifier is written
+    directly into its region of the assembled image.
+
+    Parameters
+    ----------
+    ccd : `~astropy.nddata.CCDData` or list of `~astropy.nddata.CCDData`
+        Raw image containing all amplifiers, or one image per amplifier in
+        the order of ``layout``.
+
+    layout : `~ccdproc.AmplifierLayout`
+        Sections, gains and read noises of the amplifiers.
+
+    error : bool, optional
+        If True, create an uncertainty array from the gain and read noise of
+        each amplifier.
+        Default is ``False``.
+
+    method : str, optional
+        Overscan estimator; see `~ccdproc.overscan_estimate`.
+        Default is ``'median'``.
+
+    method_kwargs : dict or None, optional
+        Additional keyword arguments for `~ccdproc.overscan_estimate`.
+        Default is ``None``.
+
+    n_threads : int, optional
+        Number of amplifiers processed in parallel.
+        Default is ``1``.
+
+    {log}
+
+    Raises
+    ------
+    TypeError
+        If ``ccd`` or ``layout`` are not the correct objects.
+
+    ValueError
+        If only some amplifiers have a gain, the gains have different units,
+        or ``error`` is requested for an amplifier without read noise.
+
+    Returns
+    -------
+    ccd : `~astropy.nddata.CCDData`
+        The assembled image. It is in the units of the gain times the unit of
+        the raw data if the amplifiers have a gain.
+    """
+    if not isinstance(layout, AmplifierLayout):
+        raise TypeError('layout is not an AmplifierLayout.')
+
+    if isinstance(ccd, CCDData):
+        raws = [ccd] * len(layout)
+    else:
+        raws = list(ccd)
+        if len(raws) != len(layout):
+            raise ValueError('need one image per amplifier.')
+    for raw in raws:
+        if not isinstance(raw, CCDData):
+            raise TypeError('ccd is not a CCDData or a list of CCDData.')
+
+    gains = [amp.gain for amp in layout]
+    if any(gain is None for gain in gains):
+        if not all(gain is None for gain in gains):
+            raise ValueError('either all or none of the amplifiers must have '
+                             'a gain.')
+        unit = raws[0].unit
+    else:
+        gain_units = set(gain.unit for gain in gains)
+        if len(gain_units) > 1:
+            raise ValueError('the gains of all amplifiers must have the same '
+                             'unit.')
+        unit = raws[0].unit * gains[0].unit
+
+    if error:
+        for amp in layout:
+            if amp.readnoise is None:
+                raise ValueError('readnoise must be specified for every '
+                                 'amplifier to create the error frame.')
+            if amp.readnoise.unit != unit:
+                raise u.UnitsError('units of data, gain and readnoise do not '
+                                   'match.')
+
+    shape = layout.shape
+    output = np.empty(shape, dtype=np.float64)
+    deviation = np.empty(shape, dtype=np.float64) if error else None
+    has_mask = any(raw.mask is not None for raw in raws)
+    mask = np.zeros(shape, dtype=bool) if has_mask else None
+    method_kwargs = method_kwargs or {}
+
+    def process(item):
+        raw, amp, detector_slice = item
+        _process_one_amplifier(raw.data, raw.mask, amp, detector_slice,
+                               output, deviation, mask, method, method_kwargs)
+
+    items = list(zip(raws, layout, layout.detector_slices))
+    if n_threads > 1:
+        pool = ThreadPool(min(n_threads, len(items)))
+        try:
+            pool.map(process, items)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for item in items:
+            process(item)
+
+    uncertainty = None if deviation is None else StdDevUncertainty(deviation)
+    return CCDData(output, unit=unit, uncertainty=uncertainty, mask=mask,
+                   meta=raws[0].meta.copy())
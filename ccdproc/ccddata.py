@@ -20,6 +20,8 @@ from astropy import log
 from astropy.utils import minversion
 from astropy.wcs import WCS
 
+from .noise_model import NoiseModelUncertainty
+
 _ASTROPY_LT_1_2 = not minversion("astropy", "1.2")
 _ASTROPY_LT_1_3 = not minversion("astropy", "1.3")
 _ASTROPY_GT_2_0 = minversion("astropy", "2.0")
@@ -369,7 +371,7 @@ class CCDData(NDDataArray):
             # We need to save some kind of information which uncertainty was
             # used so that loading the HDUList can infer the uncertainty type.
             # No idea how this can be done so only allow StdDevUncertainty.
-            if self.uncertainty.__class__.__name__ != 'StdDevUncertainty':
+            if not isinstance(self.uncertainty, StdDevUncertainty):
                 raise ValueError('only StdDevUncertainty can be saved.')
 
             # Assuming uncertainty is an StdDevUncertainty save just the array
@@ -847,4 +849,18 @@ except AttributeError:
 # CCDData moved to astropy core so we just import them from there (overwriting)
 # the classes defined here.
 if _ASTROPY_GT_2_0:
-    from astropy.nddata import fits_ccddata_reader, fits_ccddata_writer, CCDData
+    from astropy.nddata import fits_ccddata_reader, CCDData
+    from astropy.nddata import fits_ccddata_writer as _fits_ccddata_writer
+
+    def fits_ccddata_writer(ccd_data, filename, **kwd):
+        # astropy only saves uncertainties whose class is exactly
+        # StdDevUncertainty, so write an evaluated copy of a deferred one.
+        if isinstance(ccd_data.uncertainty, NoiseModelUncertainty):
+            ccd_data = CCDData(
+                ccd_data.data, unit=ccd_data.unit, mask=ccd_data.mask,
+                meta=ccd_data.meta, wcs=ccd_data.wcs,
+                uncertainty=StdDevUncertainty(ccd_data.uncertainty,
+                                              copy=False))
+        _fits_ccddata_writer(ccd_data, filename, **kwd)
+
+    fits_ccddata_writer.__doc__ = _fits_ccddata_writer.__doc__
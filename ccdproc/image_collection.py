@@ -3,13 +3,25 @@
 from __future__ import (print_function, division, absolute_import,
                         unicode_literals)
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
+import copy
+import datetime
 import fnmatch
+import gzip
+import io
+import itertools
+import json
+from multiprocessing.pool import ThreadPool
+import os
 from os import listdir, path
 import logging
+import numbers
+import re
+import sqlite3
+import sys
+import threading
 
 import numpy as np
-import numpy.ma as ma
 
 from astropy.table import Table, MaskedColumn
 import astropy.io.fits as fits
@@ -19,16 +31,838 @@ from astropy.utils import minversion
 import warnings
 from astropy.utils.exceptions import AstropyUserWarning
 
-from .ccddata import fits_ccddata_reader, _recognized_fits_file_extensions
+from .ccddata import (fits_ccddata_reader, fits_ccddata_writer,
+                      _recognized_fits_file_extensions)
 
 logger = logging.getLogger(__name__)
 
-__all__ = ['ImageFileCollection']
+__all__ = ['ImageFileCollection', 'OneOf', 'Range', 'Regex']
 __doctest_skip__ = ['*']
 
 _ASTROPY_LT_1_3 = not minversion("astropy", "1.3")
 
 
+def _header_cards(header):
+    """
+    ``(keyword, value)`` pairs of the cards of a header.
+    """
+    return list(six.iteritems(header))
+
+
+_BLOCK_LENGTH = 2880
+_CARD_LENGTH = 80
+
+# Values of keyword cards that can be converted without astropy.io.fits;
+# anything else, e.g. complex or undefined values, uses the full parser.
+_STRING_VALUE = re.compile(r"^ *'((?:[^']|'')*)' *(/.*)?$")
+_LOGICAL_VALUE = re.compile(r"^ *([TF]) *(/.*)?$")
+_INT_VALUE = re.compile(r"^ *([+-]?[0-9]+) *(/.*)?$")
+_FLOAT_VALUE = re.compile(
+    r"^ *([+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[EeDd][+-]?[0-9]+)?) *(/.*)?$")
+
+
+def _is_simple_keyword(keyword):
+    """
+    Whether the values of ``keyword`` can be read from the raw header cards.
+    """
+    return (re.match(r'^[A-Za-z0-9_-]{1,8}$', keyword) is not None and
+            keyword.lower() not in ('comment', 'history'))
+
+
+def _parse_card_value(text):
+    """
+    Value of the value field of a card, or raise `ValueError` if it needs
+    the full parser.
+    """
+    match = _STRING_VALUE.match(text)
+    if match:
+        return match.group(1).replace("''", "'").rstrip()
+    match = _LOGICAL_VALUE.match(text)
+    if match:
+        return match.group(1) == 'T'
+    match = _INT_VALUE.match(text)
+    if match:
+        return int(match.group(1))
+    match = _FLOAT_VALUE.match(text)
+    if match:
+        return float(match.group(1).replace('D', 'E').replace('d', 'e'))
+    raise ValueError('value needs the full FITS parser.')
+
+
+def _read_raw_header(fileobj):
+    """
+    Cards of the next header in ``fileobj`` up to END, or None if there is
+    no complete header.
+    """
+    cards = []
+    while True:
+        block = fileobj.read(_BLOCK_LENGTH)
+        if len(block) < _BLOCK_LENGTH:
+            return None
+        block = block.decode('ascii')
+        for start in range(0, _BLOCK_LENGTH, _CARD_LENGTH):
+            card = block[start:start + _CARD_LENGTH]
+            if card.startswith('END') and not card[3:].strip():
+                return cards
+            cards.append(card)
+
+
+def _data_size(cards):
+    """
+    Size in bytes of the data following a header, padded to full blocks.
+    """
+    values = {}
+    for card in cards:
+        keyword = card[:8].rstrip()
+        if (keyword in ('BITPIX', 'NAXIS', 'PCOUNT', 'GCOUNT') or
+                keyword.startswith('NAXIS')):
+            values[keyword] = int(card[10:].split('/')[0])
+    size = 0
+    if values.get('NAXIS', 0):
+        size = 1
+        for axis in range(1, values['NAXIS'] + 1):
+            size *= values['NAXIS{}'.format(axis)]
+    size = (abs(values['BITPIX']) // 8 * values.get('GCOUNT', 1) *
+            (size + values.get('PCOUNT', 0)))
+    return -(-size // _BLOCK_LENGTH) * _BLOCK_LENGTH
+
+
+def _read_header_keywords(file_path, ext, keywords):
+    """
+    ``(keyword, value)`` pairs of ``keywords`` in the header of extension
+    ``ext``, scanning only the header blocks of the file.
+
+    Returns None if the header cannot be handled without
+    `astropy.io.fits`, e.g. if ``ext`` is a name, the extension is not an
+    uncompressed image, a value is continued over several cards, a keyword
+    appears twice or a value is not a string, logical, integer or float.
+    """
+    if isinstance(ext, bool) or not isinstance(ext, six.integer_types):
+        return None
+    wanted = set(keyword.upper() for keyword in keywords)
+    opener = gzip.open if file_path.endswith('.gz') else open
+    try:
+        with opener(file_path, 'rb') as fileobj:
+            for hdu_index in range(ext + 1):
+                cards = _read_raw_header(fileobj)
+                first = 'SIMPLE  =' if hdu_index == 0 else 'XTENSION='
+                if cards is None or not cards[0].startswith(first):
+                    return None
+                if hdu_index < ext:
+                    fileobj.seek(_data_size(cards), os.SEEK_CUR)
+        # Tile compressed images are stored in binary tables, whose header
+        # is not the one astropy.io.fits shows for the image.
+        if ext > 0 and (_parse_card_value(cards[0][10:]) != 'IMAGE' or
+                        any(card.startswith('ZIMAGE  =') for card in cards)):
+            return None
+    except (ValueError, KeyError, UnicodeDecodeError):
+        return None
+
+    found = []
+    for index, card in enumerate(cards):
+        keyword = card[:8].rstrip()
+        if keyword not in wanted:
+            continue
+        if card[8:10] != '= ' or keyword in (k for k, _ in found):
+            return None
+        try:
+            value = _parse_card_value(card[10:])
+        except ValueError:
+            return None
+        if (isinstance(value, six.string_types) and
+                index + 1 < len(cards) and
+                cards[index + 1].startswith('CONTINUE')):
+            return None
+        found.append((keyword, value))
+    return found
+
+
+def _encode_card_value(value):
+    if isinstance(value, complex):
+        return {'complex': [value.real, value.imag]}
+    elif isinstance(value, fits.card.Undefined):
+        return {'undefined': True}
+    raise TypeError('cannot store header value {!r}.'.format(value))
+
+
+def _decode_card_value(obj):
+    if 'complex' in obj:
+        return complex(*obj['complex'])
+    elif 'undefined' in obj:
+        return fits.card.UNDEFINED
+    return obj
+
+
+def _read_ahead(read, paths, prefetch):
+    """
+    Yield ``(path, read(path))`` for each path, reading up to ``prefetch``
+    paths ahead on background threads.
+
+    ``read`` must not keep files open, so that stopping the iteration only
+    leaves the files being read open until their threads are done.
+    """
+    if prefetch < 1 or len(paths) < 2:
+        for path_ in paths:
+            yield path_, read(path_)
+        return
+
+    pool = ThreadPool(min(prefetch, len(paths)))
+    try:
+        remaining = iter(paths)
+        pending = deque((path_, pool.apply_async(read, (path_,)))
+                        for path_ in itertools.islice(remaining, prefetch))
+        while pending:
+            path_, result = pending.popleft()
+            item = result.get()
+            for next_path in itertools.islice(remaining, 1):
+                pending.append((next_path,
+                                pool.apply_async(read, (next_path,))))
+            yield path_, item
+    finally:
+        # Queued reads are dropped; the running ones finish and close their
+        # files before the threads are joined.
+        pool.terminate()
+        pool.join()
+
+
+def _write_item(item, new_path, write_kwargs):
+    """
+    Write an `~astropy.io.fits.HDUList`, and close it, or a
+    `~astropy.nddata.CCDData` to ``new_path``.
+    """
+    try:
+        if isinstance(item, fits.HDUList):
+            try:
+                item.writeto(new_path, **write_kwargs)
+            finally:
+                item.close()
+        else:
+            fits_ccddata_writer(item, new_path, **write_kwargs)
+    except IOError:
+        logger.error('error writing file %s', new_path)
+        raise
+
+
+class _BackgroundWriter(object):
+    """
+    Thread calling the functions put in a bounded queue, used to write files
+    while the next ones are processed.
+
+    The first error is raised again in the thread using the writer, by `put`
+    or `close`, and the functions put after it are not called.
+    """
+    def __init__(self, max_queued):
+        self._queue = six.moves.queue.Queue(max_queued)
+        self._error = None
+        self._error_raised = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            if self._error is None:
+                func, args = task
+                try:
+                    func(*args)
+                except Exception:
+                    self._error = sys.exc_info()
+
+    def _raise_error(self):
+        if self._error is not None and not self._error_raised:
+            self._error_raised = True
+            six.reraise(*self._error)
+
+    def put(self, func, *args):
+        """
+        Call ``func(*args)`` on the writer thread, waiting while the queue is
+        full.
+        """
+        self._raise_error()
+        self._queue.put((func, args))
+
+    def close(self):
+        """
+        Wait until all functions were called.
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+
+class _SummaryColumns(object):
+    """
+    Columns of a summary table, collected one file at a time.
+
+    Each column keeps the rows in which it has a value, so keywords missing
+    in some files are masked when the table is assembled without padding
+    the columns while collecting.
+    """
+    def __init__(self):
+        self._columns = OrderedDict()
+        self._n_rows = 0
+
+    def add_row(self, values):
+        """
+        Add the values of a file.
+
+        Parameters
+        ----------
+        values : dict
+            Values of the file by column name.
+        """
+        for name, value in six.iteritems(values):
+            try:
+                rows, column_values = self._columns[name]
+            except KeyError:
+                rows, column_values = self._columns[name] = [], []
+            rows.append(self._n_rows)
+            column_values.append(value)
+        self._n_rows += 1
+
+    def table(self):
+        """
+        `~astropy.table.Table` with a masked column for each name.
+        """
+        columns = []
+        for name, (rows, values) in six.iteritems(self._columns):
+            data = np.array(values)
+            # Keep values of different types instead of converting them all
+            # to strings.
+            if (data.dtype.kind in 'SU' and not
+                    all(isinstance(v, six.string_types) for v in values)):
+                data = np.empty(len(values), dtype=object)
+                data[:] = values
+            mask = np.ones(self._n_rows, dtype=bool)
+            mask[rows] = False
+            if len(rows) < self._n_rows:
+                # Missing values are None in object columns and zero
+                # otherwise.
+                if data.dtype.kind == 'O':
+                    column_data = np.empty(self._n_rows, dtype=object)
+                else:
+                    column_data = np.zeros(self._n_rows, dtype=data.dtype)
+                column_data[rows] = data
+                data = column_data
+            columns.append(MaskedColumn(name=name, data=data, mask=mask))
+        return Table(columns, masked=True)
+
+
+class _HeaderIndex(object):
+    """
+    SQLite file keeping the header cards of FITS files, which are read again
+    only if the size or modification time of the file changed. The files are
+    identified by their absolute path.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the SQLite file.
+
+    ext : str or int
+        Extension of the headers.
+    """
+    def __init__(self, filename, ext):
+        self._ext = str(ext)
+        self._connection = sqlite3.connect(filename)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS headers (path TEXT, ext TEXT, '
+                'size INTEGER, mtime REAL, cards TEXT, '
+                'PRIMARY KEY (path, ext))')
+
+    def close(self):
+        self._connection.close()
+
+    def headers(self, file_paths, read_headers, location):
+        """
+        Header cards of the files, from the index where it is up to date.
+
+        Entries of files in ``location`` that are neither in ``file_paths``
+        nor exist anymore are removed.
+
+        Parameters
+        ----------
+        file_paths : list of str
+            Paths to the files.
+
+        read_headers : callable
+            Called with the paths of the files that have to be read, yielding
+            their path and `~astropy.io.fits.Header` or `IOError` in order.
+
+        location : str
+            Directory of the files.
+
+        Yields
+        ------
+        file_path, cards : str, list or `IOError`
+            Path and ``(keyword, value)`` pairs of each file, in the order of
+            ``file_paths``.
+        """
+        rows = self._connection.execute(
+            'SELECT path, size, mtime, cards FROM headers WHERE ext = ?',
+            (self._ext,))
+        indexed = dict((row[0], row[1:]) for row in rows)
+        absolute_paths = dict((file_path, os.path.abspath(file_path))
+                              for file_path in file_paths)
+
+        directory = os.path.join(os.path.abspath(location), '')
+        listed = set(six.itervalues(absolute_paths))
+        removed = [(indexed_path,) for indexed_path in indexed
+                   if indexed_path.startswith(directory) and
+                   indexed_path not in listed and
+                   not os.path.exists(indexed_path)]
+        if removed:
+            with self._connection:
+                self._connection.executemany(
+                    'DELETE FROM headers WHERE path = ?', removed)
+
+        stats = {}
+        cached = {}
+        for file_path in file_paths:
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            stats[file_path] = (stat.st_size, stat.st_mtime)
+            entry = indexed.get(absolute_paths[file_path])
+            if entry is not None and tuple(entry[:2]) == stats[file_path]:
+                cached[file_path] = entry[2]
+
+        read = read_headers([file_path for file_path in file_paths
+                             if file_path not in cached])
+        new_entries = []
+        try:
+            for file_path in file_paths:
+                if file_path in cached:
+                    cards = json.loads(cached[file_path],
+                                       object_hook=_decode_card_value)
+                    yield file_path, [tuple(card) for card in cards]
+                    continue
+                file_path, header = next(read)
+                if isinstance(header, IOError):
+                    yield file_path, header
+                    continue
+                cards = _header_cards(header)
+                if file_path in stats:
+                    new_entries.append(
+                        (absolute_paths[file_path], self._ext) +
+                        stats[file_path] +
+                        (json.dumps(cards, default=_encode_card_value),))
+                yield file_path, cards
+        finally:
+            read.close()
+            if new_entries:
+                with self._connection:
+                    self._connection.executemany(
+                        'INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?)',
+                        new_entries)
+
+
+class _HandlePool(object):
+    """
+    FITS files kept open for lazy access to their data, closing the least
+    recently used file when more than ``max_open`` are open.
+
+    The files are memory mapped where possible, by default in
+    `astropy.io.fits`, and arrays that are still referenced remain valid
+    after their file is closed.
+    """
+    def __init__(self, max_open):
+        self.max_open = max_open
+        self._lock = threading.RLock()
+        self._hdulists = OrderedDict()
+
+    def _open(self, file_path, open_kwargs):
+        key = (file_path, tuple(sorted(open_kwargs.items())))
+        hdulist = self._hdulists.pop(key, None)
+        if hdulist is None:
+            hdulist = fits.open(file_path, **open_kwargs)
+        self._hdulists[key] = hdulist
+        while len(self._hdulists) > self.max_open:
+            self._hdulists.popitem(last=False)[1].close()
+        return hdulist
+
+    def hdu(self, file_path, ext, **open_kwargs):
+        """
+        HDU ``ext`` of a file; it can be used until the file is closed.
+        """
+        with self._lock:
+            return self._open(file_path, open_kwargs)[ext]
+
+    def section(self, file_path, ext, item, **open_kwargs):
+        """
+        Read part of the data of HDU ``ext`` of a file.
+        """
+        with self._lock:
+            hdu = self._open(file_path, open_kwargs)[ext]
+            section = getattr(hdu, 'section', None)
+            if section is None:
+                # Compressed images have no section in older astropy.
+                return np.array(hdu.data[item])
+            return section[item]
+
+    def close(self):
+        with self._lock:
+            while self._hdulists:
+                self._hdulists.popitem()[1].close()
+
+
+class _LazySection(object):
+    """
+    Data of an image in a FITS file, of which only the parts that are
+    indexed are read, using `astropy.io.fits.Section`.
+
+    The file is opened through a `_HandlePool`, and opened again if it was
+    closed in the meantime.
+    """
+    def __init__(self, handles, file_path, ext, open_kwargs):
+        self._handles = handles
+        self._file_path = file_path
+        self._ext = ext
+        self._open_kwargs = open_kwargs
+        self._shape = None
+
+    def __repr__(self):
+        return '<{} of {!r}[{!r}] with shape {}>'.format(
+            self.__class__.__name__, self._file_path, self._ext, self.shape)
+
+    @property
+    def shape(self):
+        if self._shape is None:
+            self._shape = self._handles.hdu(self._file_path, self._ext,
+                                            **self._open_kwargs).shape
+        return self._shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, item):
+        return self._handles.section(self._file_path, self._ext, item,
+                                     **self._open_kwargs)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[tuple(slice(None) for _ in self.shape)]
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+
+# Number of files waiting to be written by the iterators.
+_WRITE_QUEUE_SIZE = 4
+
+_NOT_A_TIME = np.iinfo(np.int64).min
+
+# Serializes adding keywords to summaries that may be shared between threads.
+_ADD_KEYWORDS_LOCK = threading.Lock()
+
+
+def _column_snapshot(column):
+    """
+    Copy of the values and the mask of a column, to detect changes made to
+    it in place.
+    """
+    return np.ma.getdata(column).copy(), np.ma.getmaskarray(column).copy()
+
+
+def _column_unchanged(column, snapshot):
+    """
+    Whether a column has the values and the mask of ``snapshot``.
+    """
+    data, mask = snapshot
+    new_data = np.ma.getdata(column)
+    if (new_data.shape != data.shape or new_data.dtype != data.dtype or
+            not np.array_equal(np.ma.getmaskarray(column), mask)):
+        return False
+    if data.dtype.kind == 'O':
+        # Lists compare identical values, like NaN, as equal.
+        return new_data.tolist() == data.tolist()
+    return new_data.tobytes() == data.tobytes()
+
+
+def _value_index(column):
+    """
+    Map each value of a column to the indices of the rows that have it.
+
+    String values are lower case and missing or NaN values are left out.
+    """
+    rows = {}
+    values = np.ma.getdata(column).tolist()
+    missing = np.ma.getmaskarray(column)
+    for row, value in enumerate(values):
+        if missing[row]:
+            continue
+        if isinstance(value, six.string_types):
+            value = value.lower()
+        elif value != value:
+            # NaN is not equal to anything, not even itself.
+            continue
+        rows.setdefault(value, []).append(row)
+
+    return dict((value, np.array(value_rows))
+                for value, value_rows in six.iteritems(rows))
+
+
+def _numbers(column):
+    """
+    Values of a column as floats, NaN where missing or not a number.
+    """
+    values = np.ma.getdata(column)
+    if values.dtype.kind in 'biuf':
+        result = values.astype(float)
+    else:
+        result = np.array([float(value)
+                           if isinstance(value, numbers.Real) else np.nan
+                           for value in values.tolist()], dtype=float)
+    result[np.ma.getmaskarray(column)] = np.nan
+    return result
+
+
+def _time(value):
+    """
+    Microseconds since 1970 of a date, or `_NOT_A_TIME`.
+    """
+    try:
+        return np.datetime64(value, 'us').astype(np.int64)
+    except (ValueError, TypeError):
+        return _NOT_A_TIME
+
+
+def _times(column):
+    """
+    Values of a column of ISO 8601 date strings, like ``DATE-OBS``, as
+    microseconds since 1970; `_NOT_A_TIME` where missing or not a date.
+    """
+    values = np.ma.getdata(column)
+    present = ~np.ma.getmaskarray(column)
+    result = np.empty(len(values), dtype=np.int64)
+    result.fill(_NOT_A_TIME)
+    if values.dtype.kind == 'U':
+        try:
+            result[present] = values[present].astype('datetime64[us]').view(
+                np.int64)
+            return result
+        except ValueError:
+            # Some values are not dates; parse them one at a time.
+            pass
+    elif values.dtype.kind != 'O':
+        return result
+    for row in np.flatnonzero(present):
+        if isinstance(values[row], six.string_types):
+            result[row] = _time(values[row])
+    return result
+
+
+class _Predicate(object):
+    """
+    Condition on the value of a keyword, for `ImageFileCollection`.
+
+    Predicates can be combined with ``&`` (and), ``|`` (or) and ``~`` (not),
+    also with plain values, which match like `OneOf`. Files without a value
+    for the keyword never match.
+    """
+    def __and__(self, other):
+        return _AllOf(self, _as_predicate(other))
+
+    def __rand__(self, other):
+        return _AllOf(_as_predicate(other), self)
+
+    def __or__(self, other):
+        return _AnyOf(self, _as_predicate(other))
+
+    def __ror__(self, other):
+        return _AnyOf(_as_predicate(other), self)
+
+    def __invert__(self):
+        return _Not(self)
+
+    def _matches(self, collection, keyword):
+        """
+        Boolean array that is `True` for the rows of the summary of
+        ``collection`` in which ``keyword`` satisfies the predicate.
+        """
+        raise NotImplementedError
+
+
+def _as_predicate(value):
+    if isinstance(value, _Predicate):
+        return value
+    return OneOf(value)
+
+
+class _AllOf(_Predicate):
+    def __init__(self, *predicates):
+        self.predicates = predicates
+
+    def __repr__(self):
+        return '({})'.format(' & '.join(repr(p) for p in self.predicates))
+
+    def _matches(self, collection, keyword):
+        return np.logical_and.reduce([p._matches(collection, keyword)
+                                      for p in self.predicates])
+
+
+class _AnyOf(_Predicate):
+    def __init__(self, *predicates):
+        self.predicates = predicates
+
+    def __repr__(self):
+        return '({})'.format(' | '.join(repr(p) for p in self.predicates))
+
+    def _matches(self, collection, keyword):
+        return np.logical_or.reduce([p._matches(collection, keyword)
+                                     for p in self.predicates])
+
+
+class _Not(_Predicate):
+    def __init__(self, predicate):
+        self.predicate = predicate
+
+    def __repr__(self):
+        return '~{!r}'.format(self.predicate)
+
+    def _matches(self, collection, keyword):
+        present = ~np.ma.getmaskarray(collection._summary[keyword])
+        return present & ~self.predicate._matches(collection, keyword)
+
+
+class Range(_Predicate):
+    """
+    Select files whose keyword value lies within bounds.
+
+    Parameters
+    ----------
+    low, high : number, str, `datetime.datetime` or None, optional
+        Lowest and highest value that matches; either one can be ``None`` to
+        leave the range open on that side. If the bounds are numbers, only
+        numeric values match. If they are dates, as `datetime.datetime`,
+        `numpy.datetime64` or ISO 8601 strings like ``'2017-12-31T18:00'``,
+        the values are parsed as ISO 8601 dates, like those of ``DATE-OBS``.
+        Default is ``None``.
+
+    Examples
+    --------
+    Exposures between 10 and 60 seconds taken in the first night of 2018::
+
+        >>> night = Range('2018-01-01T12:00', '2018-01-02T12:00')
+        >>> collection.files_filtered(exptime=Range(10, 60),
+        ...                           **{'date-obs': night})
+    """
+    def __init__(self, low=None, high=None):
+        bounds = [bound for bound in (low, high) if bound is not None]
+        dates = [isinstance(bound, (six.string_types, datetime.date,
+                                    np.datetime64))
+                 for bound in bounds]
+        if any(dates) and not all(dates):
+            raise TypeError('the bounds of a Range must both be numbers or '
+                            'both be dates.')
+        self.low = low
+        self.high = high
+        self._dates = any(dates)
+        if self._dates:
+            self._bounds = [None if bound is None else _time(bound)
+                            for bound in (low, high)]
+            if _NOT_A_TIME in self._bounds:
+                raise ValueError('cannot parse the bounds {!r} and {!r} as '
+                                 'dates.'.format(low, high))
+        else:
+            self._bounds = [low, high]
+
+    def __repr__(self):
+        return '{}({!r}, {!r})'.format(self.__class__.__name__, self.low,
+                                       self.high)
+
+    def _matches(self, collection, keyword):
+        if self._dates:
+            values = collection._column_cache(keyword, 'times', _times)
+            matches = values != _NOT_A_TIME
+        else:
+            values = collection._column_cache(keyword, 'numbers', _numbers)
+            matches = ~np.isnan(values)
+        low, high = self._bounds
+        with np.errstate(invalid='ignore'):
+            if low is not None:
+                matches &= values >= low
+            if high is not None:
+                matches &= values <= high
+        return matches
+
+
+class OneOf(_Predicate):
+    """
+    Select files whose keyword has one of several values.
+
+    Parameters
+    ----------
+    values :
+        The values that match, compared like the values given to
+        `ImageFileCollection.files_filtered`; strings are compared case
+        insensitively.
+
+    Examples
+    --------
+    All calibration frames::
+
+        >>> collection.files_filtered(imagetyp=OneOf('bias', 'dark', 'flat'))
+    """
+    def __init__(self, *values):
+        self.values = values
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__,
+                               ', '.join(repr(v) for v in self.values))
+
+    def _matches(self, collection, keyword):
+        matches = np.zeros(len(collection._summary), dtype=bool)
+        for value in self.values:
+            matches[collection._rows_with_value(keyword, value)] = True
+        return matches
+
+
+class Regex(_Predicate):
+    """
+    Select files whose keyword value contains a match of a regular
+    expression.
+
+    Parameters
+    ----------
+    pattern : str
+        Regular expression, searched for case insensitively with
+        `re.search`; use ``^`` and ``$`` to match the whole value. Only
+        string values match.
+
+    Examples
+    --------
+    Images of the M 13 or M 92 fields that are not focus frames::
+
+        >>> collection.files_filtered(
+        ...     object=Regex(r'^m ?(13|92)') & ~Regex('focus'))
+    """
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self._regex = re.compile(pattern, re.IGNORECASE)
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.pattern)
+
+    def _matches(self, collection, keyword):
+        matches = np.zeros(len(collection._summary), dtype=bool)
+        # The column is searched once per distinct value.
+        index = collection._column_cache(keyword, 'index', _value_index)
+        for value, rows in six.iteritems(index):
+            if (isinstance(value, six.string_types) and
+                    self._regex.search(value)):
+                matches[rows] = True
+        return matches
+
+
 class ImageFileCollection(object):
     """
     Representation of a collection of image files.
@@ -82,6 +916,28 @@ class ImageFileCollection(object):
          The extension from which the header and data will be read in all files.
          Default is ``0``.
 
+    n_threads : int, optional
+        Number of threads reading the FITS headers when the summary is built;
+        more than one mainly helps if the files are on network storage.
+        Default is ``1``.
+
+    progress : callable or None, optional
+        Function called as ``progress(n_read, n_files)`` after each header
+        has been read while the summary is built.
+        Default is ``None``.
+
+    index_file : str or None, optional
+        Path to a SQLite file in which the keywords of the headers are kept
+        between sessions, created if it does not exist. When the summary is
+        built only the headers of files that are new or whose size or
+        modification time changed are read again.
+        Default is ``None``.
+
+    max_open_files : int, optional
+        Maximum number of files kept open for the ``lazy`` iterators; see
+        `close`.
+        Default is ``64``.
+
     Raises
     ------
     ValueError
@@ -89,7 +945,9 @@ class ImageFileCollection(object):
         value.
     """
     def __init__(self, location=None, keywords=None, info_file=None,
-                 filenames=None, glob_include=None, glob_exclude=None, ext=0):
+                 filenames=None, glob_include=None, glob_exclude=None, ext=0,
+                 n_threads=1, progress=None, index_file=None,
+                 max_open_files=64):
 
         if info_file is not None:
             warnings.warn("The 'info_file' argument is deprecated and will be "
@@ -107,8 +965,17 @@ class ImageFileCollection(object):
 
         self._location = location
         self._filenames = filenames
+        self._n_threads = n_threads
+        self._progress = progress
+        self._index_file = index_file
+        self._handles = _HandlePool(max_open_files)
         self._files = []
         self._info_file = info_file
+        self._column_caches = {}
+        # Indices of the rows of the summary in a view made by ``filter``.
+        self._rows = None
+        # Whether the summary may be shared with views made by ``filter``.
+        self._shares_summary = False
         if location:
             self._files = self._get_files()
 
@@ -188,7 +1055,24 @@ class ImageFileCollection(object):
         else:
             filenames = "filenames={}".format(self._filenames)
 
-        params = [location, kw, infofile, filenames, glob_include, glob_exclude, ext]
+        if self.n_threads == 1:
+            n_threads = ""
+        else:
+            n_threads = "n_threads={}".format(self.n_threads)
+
+        if self._index_file is None:
+            index_file = ""
+        else:
+            index_file = "index_file={!r}".format(self._index_file)
+
+        if self._handles.max_open == 64:
+            max_open_files = ""
+        else:
+            max_open_files = "max_open_files={}".format(
+                self._handles.max_open)
+
+        params = [location, kw, infofile, filenames, glob_include, glob_exclude,
+                  ext, n_threads, index_file, max_open_files]
         params = ', '.join([p for p in params if p])
 
         str_repr = "{self.__class__.__name__}({params})".format(
@@ -218,8 +1102,13 @@ class ImageFileCollection(object):
         If an explicit list of keywords was supplied in setting up the
         collection then the order of the columns is the order of the
         keywords.
+
+        For a collection returned by `filter` this is a copy of the rows of
+        the files in it.
         """
-        return self._summary
+        if self._rows is None or not self._summary:
+            return self._summary
+        return self._summary[self._rows]
 
     @property
     def summary_info(self):
@@ -236,7 +1125,7 @@ class ImageFileCollection(object):
         warnings.warn('"summary_info" is deprecated and will be removed in '
                       'a future version. Use the "summary" attribute instead.',
                       AstropyUserWarning)
-        return self._summary
+        return self.summary
 
     @property
     def location(self):
@@ -256,8 +1145,8 @@ class ImageFileCollection(object):
         .. versionchanged:: 1.3
             Added ``deleter`` for ``keywords`` property.
         """
-        if self.summary:
-            return self.summary.keys()
+        if self._summary:
+            return self._summary.keys()
         else:
             return []
 
@@ -267,6 +1156,7 @@ class ImageFileCollection(object):
         # summary sets the keywords.
         if keywords is None:
             self._summary = []
+            self._rows = None
             return
 
         if keywords == '*':
@@ -291,6 +1181,17 @@ class ImageFileCollection(object):
             cut_keys = current_set.difference(new_keys_set)
             logging.debug('will try removing columns: %s.',
                           ' '.join(cut_keys))
+            # Never remove the columns of a summary shared with other
+            # collections: a view made by filter gets a table of its rows,
+            # the collection it was made from a table of the same columns.
+            if self._rows is not None:
+                self._summary = self.summary
+                self._rows = None
+                self._column_caches = {}
+            elif self._shares_summary:
+                self._summary = self._summary.copy(copy_data=False)
+                self._column_caches = {}
+            self._shares_summary = False
             for key in cut_keys:
                 self._summary.remove_column(key)
             logging.debug('after removal column names are: %s.',
@@ -300,12 +1201,14 @@ class ImageFileCollection(object):
             # Reorder the keywords to match the initial ordering.
             new_keys_lst.sort(key=keywords.index)
             self._summary = self._fits_summary(new_keys_lst)
+            self._rows = None
 
     @keywords.deleter
     def keywords(self):
         # since keywords are drawn from self._summary, setting
         # _summary = [] deletes the keywords.
         self._summary = []
+        self._rows = None
 
     @property
     def files(self):
@@ -338,6 +1241,13 @@ class ImageFileCollection(object):
         """
         return self._ext
 
+    @property
+    def n_threads(self):
+        """
+        int, Number of threads reading the FITS headers.
+        """
+        return self._n_threads
+
     def values(self, keyword, unique=False):
         """
         List of values for a keyword.
@@ -379,6 +1289,8 @@ class ImageFileCollection(object):
             ``**kwd`` is dict of keywords and values the files must have.
             The value '*' represents any value.
             A missing keyword is indicated by value ''.
+            The value can also be a `Range`, `OneOf` or `Regex` predicate,
+            or a combination of them with ``&``, ``|`` and ``~``.
 
         Returns
         -------
@@ -402,31 +1314,88 @@ class ImageFileCollection(object):
             >>> add_filters = {'exp-time': 20, 'ESO TPL ID': 1050}
             >>> collection.files_filtered(imagetyp='LIGHT', **add_filters)
 
+        Predicates select ranges of values, sets of values or values matching
+        a regular expression::
+
+            >>> collection.files_filtered(exptime=Range(high=30),
+            ...                           filter=OneOf('B', 'V') | Regex('^sdss'))
+            >>> night = Range('2018-01-01T12:00', '2018-01-02T12:00')
+            >>> collection.files_filtered(**{'date-obs': night})
+
         Notes
         -----
         Value comparison is case *insensitive* for strings.
-        """
-        # force a copy by explicitly converting to a list
-        current_file_mask = list(self.summary['file'].mask)
 
+        Keywords that are not in the summary yet are read from the FITS
+        headers and added to the summary, so that filtering on them again
+        does not read the files. Each keyword used for filtering is indexed
+        by value the first time, and later filters on it only look up the
+        matching files.
+        """
         include_path = kwd.pop('include_path', False)
 
-        self._find_keywords_by_values(**kwd)
-        filtered_files = self.summary['file'].compressed()
-        self.summary['file'].mask = current_file_mask
+        rows = self._filtered_rows(**kwd)
+        filtered_files = np.ma.getdata(self._summary['file'])[rows]
         if include_path:
             filtered_files = [path.join(self._location, f)
                               for f in filtered_files]
         return filtered_files
 
+    def filter(self, **kwd):
+        """
+        Create a collection of the files whose keywords have listed values.
+
+        Parameters
+        ----------
+        **kwd :
+            Keywords and values the files must have; see `files_filtered`.
+
+        Returns
+        -------
+        collection : `ImageFileCollection`
+            Collection of the matching files. It shares the summary of this
+            collection, keeping only the indices of its rows, so creating it
+            does not read the files or copy the summary. Its iterators and
+            `files_filtered` can be used from several threads at the same
+            time.
+
+        Examples
+        --------
+        Iterate over the light frames of each filter::
+
+            >>> lights = collection.filter(imagetyp='light')
+            >>> for band in lights.values('filter', unique=True):
+            ...     for ccd in lights.ccds(filter=band):
+            ...         pass
+        """
+        self._shares_summary = True
+        view = copy.copy(self)
+        view._rows = self._filtered_rows(**kwd)
+        view._files = list(np.ma.getdata(self._summary['file'])[view._rows])
+        return view
+
+    def close(self):
+        """
+        Close the files kept open by the ``lazy`` iterators.
+
+        Sections yielded by `data` remain usable and open their file again
+        when they are indexed; HDUs yielded by `hdus` can only be used until
+        their file is closed.
+        """
+        self._handles.close()
+
     def refresh(self):
         """
         Refresh the collection by re-reading headers.
         """
         keywords = '*' if self._all_keywords else self.keywords
-        # Re-load list of files
-        self._files = self._get_files()
+        # Re-load list of files; a collection returned by filter keeps its
+        # files.
+        if self._rows is None:
+            self._files = self._get_files()
         self._summary = self._fits_summary(header_keywords=keywords)
+        self._column_caches = {}
+        self._rows = None
 
     def sort(self, keys):
         """Sort the list of files to determine the order of iteration.
@@ -439,8 +1408,17 @@ class ImageFileCollection(object):
         keys : str, list of str
             The key(s) to order the table by.
         """
+        if keys is None:
+            raise ValueError('the keys to sort the collection by are '
+                             'required.')
         if len(self._summary) > 0:
-            self._summary.sort(keys)
+            if self._rows is None:
+                # Sort a copy of the summary, collections returned by filter
+                # keep sharing the current one.
+                self._summary = self._summary[self._summary.argsort(keys)]
+                self._column_caches = {}
+            else:
+                self._rows = self._rows[self.summary.argsort(keys)]
             self._files = list(self.summary['file'])
 
     def _get_files(self):
@@ -469,76 +1447,53 @@ class ImageFileCollection(object):
 
         return files
 
-    def _dict_from_fits_header(self, file_name, input_summary=None,
-                               missing_marker=None):
+    def _dict_from_fits_header(self, file_name, header=None):
         """
-        Construct an ordered dictionary whose keys are the header keywords
-        and values are a list of the values from this file and the input
-        dictionary. If the input dictionary is ordered then that order is
-        preserved.
+        Construct an ordered dictionary whose keys are the header keywords,
+        in lower case, and values are the values from this file, in the
+        order of the header. The first key is ``'file'``, the name of the
+        file.
 
         Parameters
         ----------
         file_name : str
             Name of FITS file.
 
-        input_summary : dict or None, optional
-            Existing dictionary to which new values should be appended.
-            Default is ``None``.
-
-        missing_marker : any type, optional
-            Fill value for missing header-keywords.
+        header : `~astropy.io.fits.Header`, list or None, optional
+            Header of the file if it has already been read, or its
+            ``(keyword, value)`` pairs.
             Default is ``None``.
 
         Returns
         -------
-        file_table : `~astropy.table.Table`
+        file_values : `~collections.OrderedDict`
         """
-
-        def _add_val_to_dict(key, value, tbl_dict, n_previous, missing_marker):
-            try:
-                tbl_dict[key].append(value)
-            except KeyError:
-                tbl_dict[key] = [missing_marker] * n_previous
-                tbl_dict[key].append(value)
-
-        if input_summary is None:
-            summary = OrderedDict()
-            n_previous = 0
+        if header is None:
+            header = fits.getheader(file_name, self.ext)
+        if isinstance(header, list):
+            cards = header
         else:
-            summary = input_summary
-            n_previous = len(summary['file'])
-
-        h = fits.getheader(file_name, self.ext)
+            cards = _header_cards(header)
 
-        assert 'file' not in h
-
-        # Try opening header before this so that file name is only added if
-        # file is valid FITS
-        try:
-            summary['file'].append(path.basename(file_name))
-        except KeyError:
-            summary['file'] = [path.basename(file_name)]
-
-        missing_in_this_file = [k for k in summary if (k not in h and
-                                                       k != 'file')]
+        file_values = OrderedDict()
+        file_values['file'] = path.basename(file_name)
 
         multi_entry_keys = {'comment': [],
                             'history': []}
 
-        alreadyencountered = set()
-        for k, v in six.iteritems(h):
+        for k, v in cards:
             if k == '':
                 continue
 
             k = k.lower()
+            assert k != 'file'
 
             if k in ['comment', 'history']:
                 multi_entry_keys[k].append(str(v))
                 # Accumulate these in a separate dictionary until the
                 # end to avoid adding multiple entries to summary.
                 continue
-            elif k in alreadyencountered:
+            elif k in file_values:
                 # The "normal" multi-entries HISTORY, COMMENT and BLANK are
                 # already processed so any further duplication is probably
                 # a mistake. It would lead to problems in ImageFileCollection
@@ -549,23 +1504,14 @@ class ImageFileCollection(object):
                     ''.format(k=k, v=v, f=file_name),
                     UserWarning)
                 continue
-            else:
-                # Add the key to the already encountered keys so we don't add
-                # it more than once.
-                alreadyencountered.add(k)
 
-            _add_val_to_dict(k, v, summary, n_previous, missing_marker)
+            file_values[k] = v
 
         for k, v in six.iteritems(multi_entry_keys):
             if v:
-                joined = ','.join(v)
-                _add_val_to_dict(k, joined, summary, n_previous,
-                                 missing_marker)
-
-        for missing in missing_in_this_file:
-            summary[missing].append(missing_marker)
+                file_values[k] = ','.join(v)
 
-        return summary
+        return file_values
 
     def _set_column_name_case_to_match_keywords(self, header_keys,
                                                 summary_table):
@@ -577,7 +1523,7 @@ class ImageFileCollection(object):
                 except KeyError:
                     pass
 
-    def _fits_summary(self, header_keywords):
+    def _fits_summary(self, header_keywords, file_names=None):
         """
         Generate a summary table of keywords from FITS headers.
 
@@ -586,9 +1532,15 @@ class ImageFileCollection(object):
         header_keywords : list of str or '*'
             Keywords whose value should be extracted from FITS headers or '*'
             to extract all.
+
+        file_names : list of str or None, optional
+            Files to summarize instead of `files`.
+            Default is ``None``.
         """
+        if file_names is None:
+            file_names = self.files
 
-        if not self.files:
+        if not file_names:
             return None
 
         # Make sure we have a list...for example, in python 3, dict.keys()
@@ -599,34 +1551,45 @@ class ImageFileCollection(object):
         header_keys = set(original_keywords)
         header_keys.add('file')
 
-        file_name_column = MaskedColumn(name='file', data=self.files)
+        file_name_column = MaskedColumn(name='file', data=file_names)
 
         if not header_keys or (header_keys == {'file'}):
             summary_table = Table(masked=True)
             summary_table.add_column(file_name_column)
             return summary_table
 
-        summary_dict = None
-        missing_marker = None
-
-        for file_name in file_name_column:
-            file_path = path.join(self.location, file_name)
-            try:
-                # Note: summary_dict is an OrderedDict, so should preserve
-                # the order of the keywords in the FITS header.
-                summary_dict = self._dict_from_fits_header(
-                    file_path, input_summary=summary_dict,
-                    missing_marker=missing_marker)
-            except IOError as e:
-                logger.warning('unable to get FITS header for file %s: %s.',
-                               file_path, e)
-                continue
-
-        summary_table = Table(summary_dict, masked=True)
-
-        for column in summary_table.colnames:
-            summary_table[column].mask = [v is missing_marker
-                                          for v in summary_table[column]]
+        summary_columns = _SummaryColumns()
+
+        file_paths = [path.join(self.location, file_name)
+                      for file_name in file_name_column]
+        if self._index_file is None:
+            index = None
+            # Only the requested keywords are needed; the index needs all.
+            keywords = [k for k in header_keys if k != 'file']
+            if not all(_is_simple_keyword(k) for k in keywords):
+                keywords = None
+            headers = self._read_headers(file_paths, keywords=keywords)
+        else:
+            index = _HeaderIndex(self._index_file, self.ext)
+            headers = index.headers(file_paths, self._read_headers,
+                                    self.location)
+        try:
+            for n_read, (file_path, header) in enumerate(headers, start=1):
+                if self._progress is not None:
+                    self._progress(n_read, len(file_paths))
+                if isinstance(header, IOError):
+                    logger.warning('unable to get FITS header for file %s: '
+                                   '%s.', file_path, header)
+                    continue
+                # The columns keep the order in which the keywords first
+                # appear in the FITS headers.
+                summary_columns.add_row(
+                    self._dict_from_fits_header(file_path, header=header))
+        finally:
+            if index is not None:
+                index.close()
+
+        summary_table = summary_columns.table()
 
         self._set_column_name_case_to_match_keywords(header_keys,
                                                      summary_table)
@@ -652,80 +1615,166 @@ class ImageFileCollection(object):
 
         return summary_table
 
-    def _find_keywords_by_values(self, **kwd):
+    def _read_header(self, file_path, keywords=None):
+        try:
+            if keywords is not None:
+                cards = _read_header_keywords(file_path, self.ext, keywords)
+                if cards is not None:
+                    return file_path, cards
+            return file_path, fits.getheader(file_path, self.ext)
+        except IOError as e:
+            return file_path, e
+
+    def _read_headers(self, file_paths, keywords=None):
         """
-        Find files whose keywords have given values.
+        Read the headers of ``file_paths`` on `n_threads` threads.
 
-        `**kwd` is list of keywords and values the files must have.
+        Parameters
+        ----------
+        file_paths : list of str
+            Paths to the files.
 
-        The value '*' represents any value.
-        A missing keyword is indicated by value ''
+        keywords : list of str or None, optional
+            If given only these keywords are needed, and they are read
+            without parsing the whole header where possible.
+            Default is ``None``.
 
-        Example::
+        Yields
+        ------
+        file_path, header : str, `~astropy.io.fits.Header`, list or `IOError`
+            Path and header of each file, in the order of ``file_paths``; the
+            ``(keyword, value)`` pairs of ``keywords`` instead of the header
+            if only these were read, and the error if the file could not be
+            read.
+        """
+        def read_header(file_path):
+            return self._read_header(file_path, keywords)
 
-            >>> keys = ['imagetyp','filter']
-            >>> collection = ImageFileCollection('test/data', keywords=keys)
-            >>> collection.files_filtered(imagetyp='LIGHT', filter='R')
-            >>> collection.files_filtered(imagetyp='*', filter='')
+        if self.n_threads > 1 and len(file_paths) > 1:
+            pool = ThreadPool(min(self.n_threads, len(file_paths)))
+            try:
+                for result in pool.imap(read_header, file_paths):
+                    yield result
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for file_path in file_paths:
+                yield read_header(file_path)
 
-        NOTE: Value comparison is case *insensitive* for strings.
+    def _filtered_rows(self, **kwd):
+        """
+        Indices of the rows of the summary of the files in this collection
+        whose keywords have the values in ``**kwd``; see `files_filtered`.
         """
-        keywords = kwd.keys()
-        values = kwd.values()
+        matches = self._filter_mask(**kwd)
+        if self._rows is None:
+            return np.flatnonzero(matches)
+        return self._rows[matches[self._rows]]
 
-        if set(keywords).issubset(self.keywords):
-            # we already have the information in memory
-            use_info = self.summary
-        else:
-            # we need to load information about these keywords.
-            use_info = self._fits_summary(header_keywords=keywords)
+    def _filter_mask(self, **kwd):
+        """
+        Boolean array that is `True` for the rows of the summary whose
+        keywords have the values in ``**kwd``, including the rows of files
+        that are not in a collection returned by `filter`.
+        """
+        missing_keywords = [key for key in kwd if key not in self.keywords]
+        if missing_keywords:
+            self._add_keywords(missing_keywords)
 
-        matches = np.ones(len(use_info), dtype=bool)
-        for key, value in zip(keywords, values):
+        matches = np.ones(len(self._summary), dtype=bool)
+        for key, value in six.iteritems(kwd):
             logger.debug('key %s, value %s', key, value)
-            logger.debug('value in table %s', use_info[key])
-            value_missing = use_info[key].mask
-            logger.debug('value missing: %s', value_missing)
-            value_not_missing = np.logical_not(value_missing)
-            if value == '*':
-                have_this_value = value_not_missing
+            value_missing = np.ma.getmaskarray(self._summary[key])
+            if isinstance(value, _Predicate):
+                have_this_value = value._matches(self, key)
+            elif value == '*':
+                have_this_value = ~value_missing
             elif value is not None:
-                if isinstance(value, six.string_types):
-                    # need to loop explicitly over array rather than using
-                    # where to correctly do string comparison.
-                    have_this_value = np.zeros(len(use_info), dtype=bool)
-                    for idx, file_key_value in enumerate(use_info[key]):
-                        if value_not_missing[idx]:
-                            try:
-                                value_matches = (
-                                    file_key_value.lower() == value.lower())
-                            except AttributeError:
-                                # In case we're dealing with an object column
-                                # there could be values other than strings in it
-                                # so it could fail with an AttributeError.
-                                value_matches = False
-                        else:
-                            value_matches = False
-
-                        have_this_value[idx] = (value_not_missing[idx] &
-                                                value_matches)
-                else:
-                    have_this_value = value_not_missing
-                    tmp = (use_info[key][value_not_missing] == value)
-                    have_this_value[value_not_missing] = tmp
-                    have_this_value &= value_not_missing
+                have_this_value = np.zeros(len(self._summary), dtype=bool)
+                have_this_value[self._rows_with_value(key, value)] = True
             else:
                 # this case--when value==None--is asking for the files which
                 # are missing a value for this keyword
                 have_this_value = value_missing
 
             matches &= have_this_value
+        return matches
+
+    def _rows_with_value(self, keyword, value):
+        """
+        Indices of the rows of the summary in which ``keyword`` has
+        ``value``, comparing strings case insensitively.
+        """
+        if isinstance(value, six.string_types):
+            value = value.lower()
+        try:
+            index = self._column_cache(keyword, 'index', _value_index)
+            return index.get(value, np.array([], int))
+        except TypeError:
+            # Unhashable values, e.g. arrays, are compared with numpy.
+            column = self._summary[keyword]
+            not_missing = ~np.ma.getmaskarray(column)
+            matches = np.zeros(len(column), dtype=bool)
+            matches[not_missing] = np.ma.getdata(column)[not_missing] == value
+            return np.flatnonzero(matches)
+
+    def _column_cache(self, keyword, kind, compute):
+        """
+        Result of ``compute`` applied to a column of the summary.
+
+        The result is computed on first use and kept until the column is
+        replaced or changed, e.g. through `summary`, so that repeated
+        filtering on the same keyword only compares the column with a copy
+        instead of computing the result again.
+        """
+        column = self._summary[keyword]
+        cached = self._column_caches.get((keyword, kind))
+        if (cached is not None and cached[0] is column and
+                _column_unchanged(column, cached[1])):
+            return cached[2]
+        result = compute(column)
+        self._column_caches[keyword, kind] = (column, _column_snapshot(column),
+                                              result)
+        return result
+
+    def _add_keywords(self, keywords):
+        """
+        Read ``keywords`` from the FITS headers and add them as columns to the
+        summary, so that they are read only once.
 
-        # the numpy convention is that the mask is True for values to
-        # be omitted, hence use ~matches.
-        logger.debug('Matches: %s', matches)
-        self.summary['file'].mask = ma.nomask
-        self.summary['file'].mask[~matches] = True
+        The summary may be shared with collections returned by `filter`, so
+        the keywords are read for all its files.
+        """
+        with _ADD_KEYWORDS_LOCK:
+            # Another thread may have added them in the meantime.
+            keywords = [key for key in keywords
+                        if key not in self._summary.colnames]
+            if keywords:
+                self._add_summary_columns(keywords)
+
+    def _add_summary_columns(self, keywords):
+        file_names = list(np.ma.getdata(self._summary['file']))
+        new_columns = self._fits_summary(header_keywords=keywords,
+                                         file_names=file_names)
+        row_of_file = dict((file_name, row) for row, file_name
+                           in enumerate(new_columns['file']))
+        # Files that could not be read are missing in the new columns.
+        rows = np.array([row_of_file.get(file_name, -1)
+                         for file_name in file_names], dtype=int)
+        found = rows >= 0
+        same_rows = np.array_equal(rows, np.arange(len(new_columns)))
+        for key in keywords:
+            new_column = new_columns[key]
+            if same_rows:
+                column = new_column
+            else:
+                data = np.zeros(len(rows), dtype=new_column.dtype)
+                mask = np.ones(len(rows), dtype=bool)
+                data[found] = np.ma.getdata(new_column)[rows[found]]
+                mask[found] = np.ma.getmaskarray(new_column)[rows[found]]
+                column = MaskedColumn(name=key, data=data, mask=mask)
+            self._summary.add_column(column)
 
     def _fits_files_in_directory(self, extensions=None,
                                  compressed=True):
@@ -771,6 +1820,8 @@ class ImageFileCollection(object):
                    do_not_scale_image_data=True,
                    return_fname=False,
                    ccd_kwargs=None,
+                   prefetch=0,
+                   lazy=False,
                    **kwd):
         """
         Generator that yields each {name} in the collection.
@@ -782,6 +1833,11 @@ class ImageFileCollection(object):
         length, and/or ``overwrite`` is ``True``, a copy of each FITS file will
         be made.
 
+        The copy is written on a background thread when the next {name} is
+        requested, from the {name} that was yielded, so changes must be made
+        to it in place. Errors in writing are raised when requesting one of
+        the next items or at the end of the iteration.
+
         Parameters
         ----------
         save_with_name : str, optional
@@ -825,6 +1881,23 @@ class ImageFileCollection(object):
             See `~astropy.nddata.fits_ccddata_reader` for a complete list of
             parameters that can be passed through ``ccd_kwargs``.
 
+        prefetch : int, optional
+            Number of files read ahead on background threads while the
+            current {name} is used, to overlap reading the files with
+            processing them. If ``0`` each file is read when the next {name}
+            is requested.
+            Default is ``0``.
+
+        lazy : bool, optional
+            Only for `data` and `hdus`: if ``True`` the files are kept open,
+            up to ``max_open_files`` of them, and memory mapped where
+            possible, so that only the parts of the data that are used are
+            read. `data` yields a section of each image that reads the part
+            of the data that is indexed, like `~astropy.io.fits.Section`, and
+            `hdus` yields the HDU of the open file, without copying it. The
+            files cannot be saved while iterating lazily.
+            Default is ``False``.
+
         **kwd :
             Any additional keywords are used to filter the items returned; see
             `files_filtered` examples for details.
@@ -839,100 +1912,154 @@ class ImageFileCollection(object):
             If ``return_fname`` is ``True``, yield a tuple of
             ({name}, ``file name``) for the next item in the collection.
         """
-        # store mask so we can reset at end--must COPY, otherwise
-        # current_mask just points to the mask of summary
-        if not self.summary:
+        if lazy:
+            if return_type not in ('data', 'hdu'):
+                raise ValueError('lazy is only supported for data and hdus.')
+            if save_with_name or save_location or clobber or overwrite:
+                raise ValueError('files cannot be saved when they are read '
+                                 'lazily.')
+
+        if not self._summary:
             return
 
-        current_mask = {}
-        for col in self.summary.columns:
-            current_mask[col] = self.summary[col].mask
-
+        # The files are selected without changing the summary, so that the
+        # collection can be iterated over from several threads.
         if kwd:
-            self._find_keywords_by_values(**kwd)
+            paths = self._paths(self._filtered_rows(**kwd))
+        else:
+            paths = self._paths()
 
         ccd_kwargs = ccd_kwargs or {}
-
-        for full_path in self._paths():
-            add_kwargs = {'do_not_scale_image_data': do_not_scale_image_data}
-
-            # We need to open the file here, get the appropriate values and then
-            # close it again before it "yields" otherwise it's not garantueed
-            # that the generator actually advances and closes the file again.
-            # For example if one uses "next" on the generator manually the
-            # file handle could "leak".
-            if return_type == 'header':
-                return_thing = fits.getheader(full_path, self.ext)
-            elif return_type == 'data':
-                return_thing = fits.getdata(full_path, self.ext, **add_kwargs)
-            elif return_type == 'ccd':
-                return_thing = fits_ccddata_reader(
-                    full_path, hdu=self.ext, **ccd_kwargs)
-            elif return_type == 'hdu':
-                with fits.open(full_path, **add_kwargs) as hdulist:
-                    ext_index = hdulist.index_of(self.ext)
-                    # Need to copy the HDU to prevent lazy loading problems
-                    # and "IO operations on closed file" errors
-                    return_thing = hdulist[ext_index].copy()
+        add_kwargs = {'do_not_scale_image_data': do_not_scale_image_data}
+        saving = bool(save_with_name or save_location or clobber or overwrite)
+
+        def read(full_path):
+            if lazy:
+                return None, self._read_lazy_item(return_type, full_path,
+                                                  add_kwargs)
+            elif saving:
+                return self._read_item_to_save(return_type, full_path,
+                                               add_kwargs, ccd_kwargs)
+            return None, self._read_item(return_type, full_path, add_kwargs,
+                                         ccd_kwargs)
+
+        # I really should have called the option overwrite from
+        # the beginning. The hack below ensures old code works,
+        # at least...
+        if clobber or overwrite:
+            if _ASTROPY_LT_1_3:
+                nuke_existing = {'clobber': True}
             else:
-                raise ValueError('no generator for {}'.format(return_type))
-
-            file_name = path.basename(full_path)
-            if return_fname:
-                yield return_thing, file_name
-            else:
-                yield return_thing
+                nuke_existing = {'overwrite': True}
+        else:
+            nuke_existing = {}
 
-            if save_location:
-                destination_dir = save_location
-            else:
-                destination_dir = path.dirname(full_path)
-            basename = path.basename(full_path)
-            if save_with_name:
-                base, ext = path.splitext(basename)
-                basename = base + save_with_name + ext
-
-            new_path = path.join(destination_dir, basename)
-
-            # I really should have called the option overwrite from
-            # the beginning. The hack below ensures old code works,
-            # at least...
-            if clobber or overwrite:
-                if _ASTROPY_LT_1_3:
-                    nuke_existing = {'clobber': True}
+        writer = _BackgroundWriter(_WRITE_QUEUE_SIZE) if saving else None
+        try:
+            for full_path, (to_write, return_thing) in _read_ahead(
+                    read, paths, prefetch):
+                file_name = path.basename(full_path)
+                if return_fname:
+                    yield return_thing, file_name
                 else:
-                    nuke_existing = {'overwrite': True}
-            else:
-                nuke_existing = {}
+                    yield return_thing
 
-            if return_type == 'ccd':
-                pass
-            elif (new_path != full_path) or nuke_existing:
-                with fits.open(full_path, **add_kwargs) as hdulist:
-                    ext_index = hdulist.index_of(self.ext)
-                    if return_type == 'hdu':
-                        hdulist[ext_index] = return_thing
-                    elif return_type == 'data':
-                        hdulist[ext_index].data = return_thing
-                    elif return_type == 'header':
-                        hdulist[ext_index].header = return_thing
+                if writer is None:
+                    continue
 
-                    try:
-                        hdulist.writeto(new_path, **nuke_existing)
-                    except IOError:
-                        logger.error('error writing file %s', new_path)
-                        raise
+                if save_location:
+                    destination_dir = save_location
+                else:
+                    destination_dir = path.dirname(full_path)
+                basename = path.basename(full_path)
+                if save_with_name:
+                    base, ext = path.splitext(basename)
+                    basename = base + save_with_name + ext
+
+                new_path = path.join(destination_dir, basename)
+
+                if (new_path != full_path) or nuke_existing:
+                    writer.put(_write_item, to_write, new_path, nuke_existing)
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def _read_item(self, return_type, full_path, add_kwargs, ccd_kwargs):
+        # We need to open the file here, get the appropriate values and then
+        # close it again before it "yields" otherwise it's not garantueed
+        # that the generator actually advances and closes the file again.
+        # For example if one uses "next" on the generator manually the
+        # file handle could "leak".
+        if return_type == 'header':
+            return_thing = fits.getheader(full_path, self.ext)
+        elif return_type == 'data':
+            return_thing = fits.getdata(full_path, self.ext, **add_kwargs)
+        elif return_type == 'ccd':
+            return_thing = fits_ccddata_reader(
+                full_path, hdu=self.ext, **ccd_kwargs)
+        elif return_type == 'hdu':
+            with fits.open(full_path, **add_kwargs) as hdulist:
+                ext_index = hdulist.index_of(self.ext)
+                # Need to copy the HDU to prevent lazy loading problems
+                # and "IO operations on closed file" errors
+                return_thing = hdulist[ext_index].copy()
+        else:
+            raise ValueError('no generator for {}'.format(return_type))
+        return return_thing
 
-        # reset mask
-        for col in self.summary.columns:
-            self.summary[col].mask = current_mask[col]
+    def _read_item_to_save(self, return_type, full_path, add_kwargs,
+                           ccd_kwargs):
+        """
+        Read a file that will be saved into memory.
 
-    def _paths(self):
+        Returns
+        -------
+        to_write : `~astropy.io.fits.HDUList` or `~astropy.nddata.CCDData`
+            Contents of the file to write.
+
+        item :
+            The header, data, HDU or `~astropy.nddata.CCDData` to yield, which
+            is part of ``to_write``.
         """
-        Full path to each file.
+        # Reading the whole file once keeps no file open while the item is
+        # used, and the file can be overwritten from the copy in memory.
+        opener = gzip.open if full_path.endswith('.gz') else open
+        with opener(full_path, 'rb') as fileobj:
+            contents = io.BytesIO(fileobj.read())
+        if return_type == 'ccd':
+            ccd = fits_ccddata_reader(contents, hdu=self.ext, **ccd_kwargs)
+            return ccd, ccd
+
+        hdulist = fits.open(contents, **add_kwargs)
+        hdu = hdulist[self.ext]
+        if return_type == 'header':
+            return hdulist, hdu.header
+        elif return_type == 'data':
+            return hdulist, hdu.data
+        elif return_type == 'hdu':
+            return hdulist, hdu
+        hdulist.close()
+        raise ValueError('no generator for {}'.format(return_type))
+
+    def _read_lazy_item(self, return_type, full_path, add_kwargs):
+        if return_type == 'hdu':
+            return self._handles.hdu(full_path, self.ext, **add_kwargs)
+        return _LazySection(self._handles, full_path, self.ext, add_kwargs)
+
+    def _paths(self, rows=None):
         """
-        unmasked_files = self.summary['file'].compressed()
-        return [path.join(self.location, file_) for file_ in unmasked_files]
+        Full path to each file, or to the files in the rows ``rows`` of the
+        summary.
+        """
+        file_column = self._summary['file']
+        if rows is None:
+            if self._rows is None:
+                rows = np.arange(len(file_column))
+            else:
+                rows = self._rows
+            rows = rows[~np.ma.getmaskarray(file_column)[rows]]
+        return [path.join(self.location, file_)
+                for file_ in np.ma.getdata(file_column)[rows]]
 
     def headers(self, do_not_scale_image_data=True, **kwd):
         return self._generator('header',
@@ -958,9 +2085,6 @@ class ImageFileCollection(object):
         name='image', default_scaling='False', return_type='numpy.ndarray')
 
     def ccds(self, ccd_kwargs=None, **kwd):
-        if kwd.get('clobber') or kwd.get('overwrite'):
-            raise NotImplementedError(
-                "overwrite=True (or clobber=True) is not supported for CCDs.")
         return self._generator('ccd', ccd_kwargs=ccd_kwargs, **kwd)
     ccds.__doc__ = _generator.__doc__.format(
         name='CCDData', default_scaling='True', return_type='astropy.nddata.CCDData')
@@ -0,0 +1,256 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+
+"""This module implements uncertainties evaluated from a noise model."""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import numpy as np
+
+from astropy.nddata import StdDevUncertainty
+
+__all__ = ['NoiseModel', 'NoiseModelUncertainty']
+
+
+class NoiseModel(object):
+    """
+    Description of the noise of an image through a calibration chain.
+
+    The operations applied to the image are recorded with references to the
+    arrays they need; the variance is only computed by `evaluate`. All
+    contributions are assumed to be uncorrelated, like in the uncertainty
+    propagation of `~astropy.nddata.NDData` arithmetic.
+
+    The arrays are not copied, so they must not be changed until the model
+    is evaluated. Steps that cannot contribute to the variance, like scaling
+    an image without noise, are not recorded, so a model of length zero
+    describes an image without uncertainty.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of the image.
+    """
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self._steps = []
+
+    def __len__(self):
+        return len(self._steps)
+
+    def set_deviation(self, deviation):
+        """
+        Start from a known standard deviation, discarding earlier steps.
+
+        Parameters
+        ----------
+        deviation : `numpy.ndarray`
+            Standard deviation of the image.
+        """
+        self._steps = [('deviation', (deviation,))]
+
+    def set_ccd_noise(self, data, gain, readnoise):
+        """
+        Start from the Poisson and read noise of the image, discarding
+        earlier steps; see `~ccdproc.create_deviation`.
+
+        Parameters
+        ----------
+        data : `numpy.ndarray`
+            Image before gain correction.
+
+        gain : float
+            Gain converting ``data`` to the unit of ``readnoise``.
+
+        readnoise : float
+            Read noise per pixel.
+        """
+        self._steps = [('ccd', (data, gain, readnoise))]
+
+    def scale(self, factor):
+        """
+        Record the multiplication of the image by a constant.
+
+        Parameters
+        ----------
+        factor : float
+            Scale factor.
+        """
+        if self._steps:
+            self._steps.append(('scale', (factor,)))
+
+    def add(self, deviation, factor=1.):
+        """
+        Record the addition or subtraction of an image.
+
+        Parameters
+        ----------
+        deviation : `numpy.ndarray`
+            Standard deviation of the image added to or subtracted from the
+            image.
+
+        factor : float, optional
+            Factor by which that image is multiplied.
+            Default is ``1``.
+        """
+        self._steps.append(('add', (deviation, factor)))
+
+    def divide(self, numerator, divisor, deviation=None, norm=1.):
+        """
+        Record the division of the image by ``divisor / norm``.
+
+        Parameters
+        ----------
+        numerator : `numpy.ndarray`
+            Image before the division.
+
+        divisor : `numpy.ndarray`
+            Image by which it is divided, before normalization.
+
+        deviation : `numpy.ndarray` or None, optional
+            Standard deviation of ``divisor``, before normalization. If
+            ``None`` the divisor has no uncertainty.
+            Default is ``None``.
+
+        norm : float, optional
+            Normalization of ``divisor``.
+            Default is ``1``.
+        """
+        if self._steps or deviation is not None:
+            self._steps.append(('divide',
+                                (numerator, divisor, deviation, norm)))
+
+    def evaluate(self, dtype=None):
+        """
+        Compute the standard deviation of the image.
+
+        Parameters
+        ----------
+        dtype : str, `numpy.dtype` or None, optional
+            Data type of the result. If ``None`` it is ``np.float64``.
+            Default is ``None``.
+
+        Returns
+        -------
+        deviation : `numpy.ndarray`
+            Standard deviation of the image.
+        """
+        variance = None
+        scratch = None
+        for step, args in self._steps:
+            if step == 'deviation':
+                variance = np.square(args[0], dtype=np.float64)
+            elif step == 'ccd':
+                data, gain, readnoise = args
+                variance = np.multiply(data, gain, dtype=np.float64)
+                variance += readnoise ** 2
+                variance /= gain ** 2
+            elif step == 'scale':
+                if variance is not None:
+                    variance *= args[0] ** 2
+            elif step == 'add':
+                deviation, factor = args
+                if variance is None:
+                    variance = np.zeros(self.shape)
+                if scratch is None:
+                    scratch = np.empty(self.shape)
+                np.multiply(deviation, factor, out=scratch)
+                scratch *= scratch
+                variance += scratch
+            elif step == 'divide':
+                numerator, divisor, deviation, norm = args
+                if scratch is None:
+                    scratch = np.empty(self.shape)
+                # scratch holds the inverse of the normalized divisor.
+                np.divide(norm, divisor, out=scratch)
+                if variance is not None:
+                    variance *= scratch
+                    variance *= scratch
+                if deviation is not None:
+                    if variance is None:
+                        variance = np.zeros(self.shape)
+                    # result * deviation / divisor, all normalized
+                    scratch *= scratch
+                    scratch *= numerator
+                    scratch *= deviation
+                    scratch /= norm
+                    scratch *= scratch
+                    variance += scratch
+        if variance is None:
+            variance = np.zeros(self.shape)
+        np.sqrt(variance, out=variance)
+        if dtype is not None:
+            variance = variance.astype(dtype, copy=False)
+        return variance
+
+
+class NoiseModelUncertainty(StdDevUncertainty):
+    """
+    Standard deviation uncertainty computed from a `NoiseModel` the first
+    time its ``array`` is used.
+
+    It behaves like `~astropy.nddata.StdDevUncertainty` otherwise, so
+    arithmetic, writing to FITS or any other access evaluates it.
+
+    Parameters
+    ----------
+    array : array-like, `~astropy.nddata.NDUncertainty` or None, optional
+        Standard deviation; see `~astropy.nddata.StdDevUncertainty`.
+        Default is ``None``.
+
+    copy : bool, optional
+        Whether to copy ``array``.
+        Default is ``True``.
+
+    unit : `~astropy.units.Unit` or None, optional
+        Unit of the uncertainty.
+        Default is ``None``.
+
+    model : `NoiseModel` or None, optional
+        Model from which the standard deviation is evaluated; ignored if
+        ``array`` is given.
+        Default is ``None``.
+    """
+    def __init__(self, array=None, copy=True, unit=None, model=None):
+        if (isinstance(array, NoiseModelUncertainty) and
+                array._model is not None):
+            # Share the model instead of evaluating it.
+            model = array._model
+            if unit is None:
+                unit = array.unit
+            array = None
+        super(NoiseModelUncertainty, self).__init__(array, copy=copy,
+                                                    unit=unit)
+        if array is None:
+            self._model = model
+
+    @property
+    def model(self):
+        """
+        `NoiseModel` not evaluated yet, or ``None``.
+        """
+        return getattr(self, '_model', None)
+
+    @property
+    def array(self):
+        """
+        `numpy.ndarray` : Standard deviation, evaluated on first access.
+        """
+        if self.model is not None:
+            self._array = self._model.evaluate()
+            self._model = None
+        return self._array
+
+    @array.setter
+    def array(self, value):
+        self._model = None
+        StdDevUncertainty.array.fset(self, value)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # The weak reference to the parent can be neither copied nor pickled.
+        state['_parent_nddata'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
@@ -0,0 +1,181 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+import pytest
+import astropy.units as u
+from astropy.io import fits
+from astropy.modeling import models
+
+from ..ccddata import CCDData
+from ..core import ccd_process
+from ..amplifiers import Amplifier, AmplifierLayout, process_amplifiers
+
+GAINS = [1.5, 2.0]
+READNOISE = 5.
+
+
+def two_amp_raw():
+    """
+    Raw 100x220 frame read by two amplifiers, each with 10 columns of
+    overscan on the outside. The left amplifier has a bias of 100 and the
+    right one a bias that increases along the lines.
+    """
+    raw = np.zeros((100, 220))
+    lines = np.arange(100.)[:, np.newaxis]
+    raw[:, :110] = 100.
+    raw[:, 110:] = 200. + lines
+    # "Science" signal, in adu of each amplifier
+    raw[:, 10:110] += 20.
+    raw[:, 110:210] += 10.
+    return CCDData(raw, unit=u.adu, meta={'object': 'test'})
+
+
+def two_amp_layout(detector_sections=(None, None)):
+    return AmplifierLayout([
+        Amplifier('[11:110,1:100]', '[1:10,1:100]',
+                  detector_section=detector_sections[0],
+                  gain=GAINS[0] * u.electron / u.adu,
+                  readnoise=READNOISE * u.electron),
+        Amplifier('[111:210,1:100]', '[211:220,1:100]',
+                  detector_section=detector_sections[1],
+                  gain=GAINS[1] * u.electron / u.adu,
+                  readnoise=READNOISE * u.electron)])
+
+
+@pytest.mark.parametrize('n_threads', [1, 2])
+def test_process_amplifiers(n_threads):
+    layout = two_amp_layout()
+    assert layout.shape == (100, 200)
+    ccd = process_amplifiers(two_amp_raw(), layout, error=True,
+                             n_threads=n_threads)
+    assert ccd.shape == (100, 200)
+    assert ccd.unit == u.electron
+    assert_allclose(ccd.data[:, :100], 20. * GAINS[0])
+    assert_allclose(ccd.data[:, 100:], 10. * GAINS[1])
+    assert_allclose(ccd.uncertainty.array[:, :100],
+                    np.sqrt(20. * GAINS[0] + READNOISE ** 2))
+    assert ccd.meta['object'] == 'test'
+
+
+def test_process_amplifiers_flipped_detector_section():
+    layout = two_amp_layout(('[1:100,1:100]', '[200:101,1:100]'))
+    raw = two_amp_raw()
+    # make the right amplifier data vary along the columns
+    raw.data[:, 110:210] += np.arange(100.)
+    ccd = process_amplifiers(raw, layout)
+    assert_allclose(ccd.data[0, 100:], GAINS[1] * (10. + np.arange(100.))[::-1])
+
+
+def test_process_amplifiers_line_flipped_detector_section():
+    # The bias of the right amplifier changes from line to line, so the
+    # overscan profile must be subtracted in the orientation of the raw data.
+    layout = two_amp_layout(('[1:100,1:100]', '[101:200,100:1]'))
+    ccd = process_amplifiers(two_amp_raw(), layout)
+    assert_allclose(ccd.data[:, :100], 20. * GAINS[0])
+    assert_allclose(ccd.data[:, 100:], 10. * GAINS[1])
+
+
+def test_process_amplifiers_one_image_per_amplifier():
+    raw = two_amp_raw()
+    layout = AmplifierLayout([
+        Amplifier('[11:110,1:100]', '[1:10,1:100]',
+                  detector_section='[1:100,1:100]'),
+        Amplifier('[1:100,1:100]', '[101:110,1:100]',
+                  detector_section='[101:200,1:100]')])
+    ccds = [raw[:, :110], raw[:, 110:]]
+    ccds[0].mask = np.zeros((100, 110), dtype=bool)
+    ccds[0].mask[0, 20] = True
+    ccd = process_amplifiers(ccds, layout)
+    assert ccd.unit == u.adu
+    assert_allclose(ccd.data[:, :100], 20.)
+    assert_allclose(ccd.data[:, 100:], 10.)
+    assert ccd.mask.sum() == 1
+    assert ccd.mask[0, 10]
+
+
+def test_process_amplifiers_fails():
+    raw = two_amp_raw()
+    with pytest.raises(TypeError):
+        process_amplifiers(raw, [Amplifier('[1:10,1:10]')])
+    with pytest.raises(ValueError):
+        process_amplifiers([raw], two_amp_layout())
+    no_readnoise = AmplifierLayout([Amplifier('[11:110,1:100]',
+                                              '[1:10,1:100]')])
+    with pytest.raises(ValueError):
+        process_amplifiers(raw, no_readnoise, error=True)
+    mixed_gain = AmplifierLayout([
+        Amplifier('[11:110,1:100]', gain=2 * u.electron / u.adu),
+        Amplifier('[111:210,1:100]')])
+    with pytest.raises(ValueError):
+        process_amplifiers(raw, mixed_gain)
+    with pytest.raises(ValueError):
+        AmplifierLayout([Amplifier('[11:110,1:100]',
+                                   detector_section='[1:100,1:100]'),
+                         Amplifier('[111:210,1:100]')])
+
+
+def test_layout_from_header():
+    header = fits.Header()
+    for number, (datasec, biassec) in enumerate(
+            [('[11:110,1:100]', '[1:10,1:100]'),
+             ('[111:210,1:100]', '[211:220,1:100]')], start=1):
+        header['DATASEC{}'.format(number)] = datasec
+        header['BIASSEC{}'.format(number)] = biassec
+        header['GAIN{}'.format(number)] = GAINS[number - 1]
+        header['RDNOISE{}'.format(number)] = READNOISE
+    layout = AmplifierLayout.from_header(header)
+    assert len(layout) == 2
+    assert layout[1].gain == GAINS[1] * u.electron / u.adu
+    assert layout[0].readnoise == READNOISE * u.electron
+    from_header = process_amplifiers(two_amp_raw(), layout)
+    expected = process_amplifiers(two_amp_raw(), two_amp_layout())
+    assert_array_equal(from_header.data, expected.data)
+
+    # A single amplifier with keywords without number
+    header = fits.Header()
+    header['DATASEC'] = '[11:110,1:100]'
+    layout = AmplifierLayout.from_header(header)
+    assert len(layout) == 1
+    assert layout[0].bias_section is None
+
+    with pytest.raises(KeyError):
+        AmplifierLayout.from_header(fits.Header())
+
+
+def test_layout_from_headers():
+    headers = [{'DATASEC': '[11:110,1:100]', 'BIASSEC': '[1:10,1:100]',
+                'DETSEC': '[1:100,1:100]', 'GAIN': 1.5},
+               {'DATASEC': '[1:100,1:100]', 'BIASSEC': '[101:110,1:100]',
+                'DETSEC': '[101:200,1:100]', 'GAIN': 2.0}]
+    layout = AmplifierLayout.from_headers(headers)
+    assert layout.shape == (100, 200)
+    assert layout[0].detector_section == '[1:100,1:100]'
+
+
+def test_ccd_process_amplifiers():
+    raw = two_amp_raw()
+    layout = two_amp_layout()
+    master_bias = CCDData(np.ones((100, 200)), unit=u.electron)
+    ccd = ccd_process(raw, amplifiers=layout, master_bias=master_bias,
+                      error=True, n_threads=2)
+    assert_allclose(ccd.data[:, :100], 20. * GAINS[0] - 1)
+    assert_allclose(ccd.data[:, 100:], 10. * GAINS[1] - 1)
+    assert ccd.uncertainty is not None
+    # The input is not changed
+    assert raw.data[0, 0] == 100.
+
+
+def test_ccd_process_amplifiers_fails():
+    raw = two_amp_raw()
+    with pytest.raises(TypeError):
+        ccd_process(raw, amplifiers=two_amp_layout(), trim='[1:10,1:10]')
+    with pytest.raises(ValueError):
+        ccd_process(raw, amplifiers=two_amp_layout(), gain_corrected=False)
+    with pytest.raises(TypeError):
+        ccd_process(raw, amplifiers=two_amp_layout(),
+                    oscan_model=models.Polynomial1D(2))
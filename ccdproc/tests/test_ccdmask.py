@@ -6,10 +6,11 @@ from __future__ import (absolute_import, division, print_function,
 from numpy.testing import assert_array_equal
 
 import numpy as np
+from scipy import ndimage
 
 import pytest
 
-from ..core import ccdmask
+from ..core import ccdmask, _fill_column_gaps, _running_percentiles
 from ..ccddata import CCDData
 
 
@@ -220,3 +221,85 @@ def test_ccdmask_pixels():
     mask = ccdmask(ratio, ncsig=11, nlsig=15, findbadcolumns=True)
     target_mask[:, 2] = True
     assert_array_equal(mask, target_mask)
+
+
+def _fill_column_gaps_loop(mask, ngood):
+    # The original line by line implementation
+    mask = mask.copy()
+    nlines, ncols = mask.shape
+    for col in range(ncols):
+        for line in range(nlines - ngood - 1):
+            if mask[line, col]:
+                for i in range(2, ngood + 2):
+                    lend = line + i
+                    if (mask[lend, col] and
+                            not np.all(mask[line:lend + 1, col])):
+                        mask[line:lend, col] = True
+    return mask
+
+
+@pytest.mark.parametrize('ngood', [1, 2, 5, 7])
+def test_fill_column_gaps(ngood):
+    rng = np.random.RandomState(ngood)
+    for nlines in [1, ngood + 1, ngood + 2, 12, 31]:
+        for fraction in [0.1, 0.4, 0.7]:
+            mask = rng.rand(nlines, 40) < fraction
+            assert_array_equal(_fill_column_gaps(mask, ngood),
+                               _fill_column_gaps_loop(mask, ngood))
+
+
+@pytest.mark.parametrize('findbadcolumns', [False, True])
+def test_ccdmask_byblocks_partial_blocks(findbadcolumns):
+    # Blocks at the upper edges are smaller than nlsig x ncsig; compare with
+    # the statistics computed block by block.
+    nlsig, ncsig, nsigma = 15, 11, 2
+    rng = np.random.RandomState(42)
+    data = rng.normal(1, 0.05, (67, 83))
+    data[rng.rand(67, 83) < 0.02] = 5
+    ratio = CCDData(data, unit='adu')
+    medsub = data - ndimage.median_filter(data, (7, 7))
+    target_mask = np.zeros(data.shape, dtype=bool)
+    for l1 in range(0, 67, nlsig):
+        for c1 in range(0, 83, ncsig):
+            block = medsub[l1:l1 + nlsig, c1:c1 + ncsig]
+            low, high = np.percentile(block, [30.9, 69.1])
+            sigma = (high - low) / 2
+            block_mask = ((block < -nsigma * sigma) |
+                          (block > nsigma * sigma))
+            if findbadcolumns:
+                csum = np.ma.sum(np.ma.MaskedArray(block, block_mask), axis=0)
+                csum[csum <= 0] = 0
+                csum_sigma = np.ma.MaskedArray(np.sqrt(block.shape[1] - csum))
+                block_mask |= ((csum.filled(1) < -nsigma * csum_sigma) |
+                               (csum.filled(1) > nsigma * csum_sigma))
+            target_mask[l1:l1 + nlsig, c1:c1 + ncsig] = block_mask
+    if findbadcolumns:
+        target_mask = _fill_column_gaps(target_mask, 5)
+    mask = ccdmask(ratio, byblocks=True, findbadcolumns=findbadcolumns,
+                   nlsig=nlsig, ncsig=ncsig, lsigma=nsigma, hsigma=nsigma)
+    assert mask.any()
+    assert_array_equal(mask, target_mask)
+
+
+@pytest.mark.parametrize('size', [(15, 15), (15, 11), (4, 6)])
+def test_running_percentiles(size):
+    rng = np.random.RandomState(0)
+    data = rng.normal(size=(33, 40))
+    low, high = _running_percentiles(data, size, [30.9, 69.1],
+                                     chunk_size=3000)
+    assert_array_equal(low, ndimage.percentile_filter(data, 30.9, size=size))
+    assert_array_equal(high, ndimage.percentile_filter(data, 69.1, size=size))
+
+
+def test_ccdmask_decimate():
+    rng = np.random.RandomState(12)
+    data = rng.normal(1, 0.05, (120, 110))
+    data[rng.rand(*data.shape) < 0.01] = 3
+    ratio = CCDData(data, unit='adu')
+    mask = ccdmask(ratio)
+    decimated_mask = ccdmask(ratio, decimate=8)
+    assert decimated_mask.sum() > 0
+    assert (mask != decimated_mask).sum() < 0.05 * mask.sum()
+    assert_array_equal(ccdmask(ratio, decimate=1), mask)
+    with pytest.raises(ValueError):
+        ccdmask(ratio, decimate=0)
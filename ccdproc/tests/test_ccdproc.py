@@ -10,6 +10,7 @@ import astropy.units as u
 from astropy.wcs import WCS
 from astropy.tests.helper import catch_warnings
 from astropy.utils.exceptions import AstropyUserWarning
+from astropy.utils import NumpyRNGContext
 
 from astropy.nddata import StdDevUncertainty
 import astropy
@@ -20,9 +21,11 @@ import pytest
 from ..ccddata import CCDData
 from ..core import (
     ccd_process, cosmicray_median, cosmicray_lacosmic, create_deviation,
-    flat_correct, gain_correct, subtract_bias, subtract_dark, subtract_overscan,
-    transform_image, trim_image, wcs_project, Keyword)
+    flat_correct, gain_correct, overscan_estimate, subtract_bias,
+    subtract_dark, subtract_overscan, transform_image, trim_image,
+    wcs_project, Keyword)
 from ..core import _blkavg
+from ..noise_model import NoiseModelUncertainty
 
 try:
     from ..core import block_reduce, block_average, block_replicate
@@ -83,6 +86,43 @@ def test_create_deviation_keywords_must_have_unit(ccd_data):
         create_deviation(ccd_data)
 
 
+@pytest.mark.data_size(10)
+def test_create_deviation_dtype(ccd_data):
+    ccd_data.data = np.abs(ccd_data.data)
+    gain = 2.0 * u.electron / u.adu
+    readnoise = 5 * u.electron
+    expected = create_deviation(ccd_data, gain=gain, readnoise=readnoise)
+    ccd_var = create_deviation(ccd_data, gain=gain, readnoise=readnoise,
+                               dtype=np.float32)
+    assert ccd_var.uncertainty.array.dtype == np.float32
+    np.testing.assert_allclose(ccd_var.uncertainty.array,
+                               expected.uncertainty.array, rtol=1e-6)
+
+
+def test_create_deviation_in_place(ccd_data):
+    ccd_var = create_deviation(ccd_data, readnoise=5 * u.adu, in_place=True)
+    assert ccd_var is ccd_data
+    assert ccd_data.uncertainty is not None
+    # Without in_place the input is left alone
+    ccd_data.uncertainty = None
+    ccd_var = create_deviation(ccd_data, readnoise=5 * u.adu)
+    assert ccd_var is not ccd_data
+    assert ccd_data.uncertainty is None
+
+
+@pytest.mark.data_size(10)
+def test_create_deviation_clip_negative(ccd_data):
+    ccd_data.data[:] = 1
+    ccd_data.data[0, 0] = -100
+    readnoise = 5 * u.adu
+    ccd_var = create_deviation(ccd_data, readnoise=readnoise)
+    assert np.isnan(ccd_var.uncertainty.array[0, 0])
+    ccd_var = create_deviation(ccd_data, readnoise=readnoise,
+                               clip_negative=True)
+    assert ccd_var.uncertainty.array[0, 0] == 5
+    assert ccd_var.uncertainty.array[0, 1] == np.sqrt(1 + 5 ** 2)
+
+
 # tests for overscan
 @pytest.mark.parametrize('data_rectangle', [False, True])
 @pytest.mark.parametrize('median,transpose', [
@@ -218,6 +258,81 @@ def test_subtract_overscan_model(ccd_data, transpose):
                                    original_mean)
 
 
+@pytest.mark.parametrize('method', ['clipped_mean', 'running_median',
+                                    'polynomial'])
+def test_overscan_estimate_rejects_outliers(method):
+    profile = 300. + 0.01 * np.arange(200.)
+    with NumpyRNGContext(123):
+        strip = profile[:, np.newaxis] + np.random.normal(size=(200, 10))
+    # A cosmic ray and a pair of hot pixels in the overscan
+    strip[5, 3] = 1e4
+    strip[50, :2] = 5e3
+    estimate = overscan_estimate(strip, method=method)
+    assert estimate.shape == profile.shape
+    assert np.abs(estimate - profile).max() < 3
+    # The plain mean is dragged off by the outliers.
+    assert np.abs(overscan_estimate(strip) - profile).max() > 100
+
+
+@pytest.mark.parametrize('method', ['mean', 'median', 'clipped_mean',
+                                    'running_median', 'polynomial'])
+def test_overscan_estimate_batch_matches_single(method):
+    with NumpyRNGContext(123):
+        strips = 300. + np.random.normal(size=(3, 50, 8))
+    batch = overscan_estimate(strips, overscan_axis=1, method=method)
+    single = [overscan_estimate(strip, overscan_axis=1, method=method)
+              for strip in strips]
+    assert batch.shape == (3, 50)
+    np.testing.assert_allclose(batch, single)
+    # The collapsed axis follows the convention of a single strip.
+    transposed = overscan_estimate(strips.transpose(0, 2, 1),
+                                   overscan_axis=0, method=method)
+    np.testing.assert_allclose(transposed, batch)
+
+
+@pytest.mark.parametrize('method', ['mean', 'median', 'clipped_mean',
+                                    'running_median', 'polynomial'])
+def test_overscan_estimate_ignores_masked_pixels(method):
+    strip = np.ma.array(np.full((50, 8), 300.), mask=np.zeros((50, 8)))
+    strip[10, 2] = 1e5
+    strip.mask[10, 2] = True
+    estimate = overscan_estimate(strip, method=method)
+    np.testing.assert_allclose(estimate, 300.)
+
+
+def test_overscan_estimate_polynomial_with_too_few_points():
+    strips = np.full((2, 20, 4), 300.)
+    # Only two finite points in the second strip, fewer than the
+    # coefficients of the polynomial.
+    strips[1, 2:] = np.nan
+    with np.errstate(invalid='ignore'):
+        estimate = overscan_estimate(strips, method='polynomial', order=3)
+    np.testing.assert_allclose(estimate[0], 300.)
+    assert np.isnan(estimate[1]).all()
+
+
+def test_overscan_estimate_fails():
+    with pytest.raises(ValueError):
+        overscan_estimate(np.zeros((10, 10)), method='mode')
+    with pytest.raises(ValueError):
+        overscan_estimate(np.zeros(10))
+
+
+def test_subtract_overscan_method(ccd_data):
+    ccd_data.data[:, :10] = 300.
+    ccd_data.data[:, 10:] += 300.
+    ccd_data.data[20, 3] = 1e5
+    # method overrides median
+    subtracted = subtract_overscan(ccd_data, overscan=ccd_data[:, :10],
+                                   median=False, method='clipped_mean')
+    assert (subtracted.data[:, :10] == 0)[np.arange(100) != 20].all()
+    assert abs(subtracted.data[20, 10:].mean()) < 1
+    subtracted = subtract_overscan(ccd_data, fits_section='[1:10, :]',
+                                   method='polynomial',
+                                   method_kwargs={'order': 0})
+    np.testing.assert_allclose(subtracted.data[:, 0], 0, atol=1e-8)
+
+
 def test_subtract_overscan_fails(ccd_data):
     # do we get an error if the *image* is neither CCDData nor an array?
     with pytest.raises(TypeError):
@@ -403,6 +518,53 @@ def test_subtract_dark_fails(ccd_data):
                       exposure_unit=u.second)
     assert "uncalibrated image" in str(e.value)
 
+    # ...also when the subtraction is fused?
+    with pytest.raises(u.UnitsError):
+        subtract_dark(ccd_data, master, exposure_time='exptime',
+                      exposure_unit=u.second, fused=True)
+
+
+@pytest.mark.parametrize('scale', [True, False])
+def test_subtract_dark_fused(ccd_data, scale):
+    ccd_data.uncertainty = np.ones_like(ccd_data.data)
+    ccd_data.mask = np.zeros(ccd_data.shape, dtype=bool)
+    ccd_data.mask[0, 0] = True
+    master = CCDData(np.full(ccd_data.shape, 2.), unit=u.adu)
+    master.uncertainty = np.full(ccd_data.shape, 0.5)
+    master.mask = np.zeros(ccd_data.shape, dtype=bool)
+    master.mask[1, 1] = True
+    kwargs = dict(dark_exposure=1 * u.minute, data_exposure=30 * u.second,
+                  scale=scale, add_keyword=None)
+    expected = subtract_dark(ccd_data, master, **kwargs)
+    dark_sub = subtract_dark(ccd_data, master, fused=True, **kwargs)
+    np.testing.assert_allclose(dark_sub.data, expected.data)
+    np.testing.assert_allclose(dark_sub.uncertainty.array,
+                               expected.uncertainty.array)
+    assert_array_equal(dark_sub.mask, expected.mask)
+    assert dark_sub.unit == expected.unit
+    assert dark_sub.meta is not ccd_data.meta
+
+
+def test_subtract_dark_cache_scaled(ccd_data):
+    master = CCDData(np.full(ccd_data.shape, 2.), unit=u.adu)
+    kwargs = dict(dark_exposure=60 * u.second, scale=True,
+                  cache_scaled=True, add_keyword=None)
+    first = subtract_dark(ccd_data, master, data_exposure=30 * u.second,
+                          **kwargs)
+    second = subtract_dark(ccd_data, master, data_exposure=30 * u.second,
+                           **kwargs)
+    other = subtract_dark(ccd_data, master, data_exposure=60 * u.second,
+                          **kwargs)
+    assert_array_equal(first.data, ccd_data.data - 1)
+    assert_array_equal(second.data, first.data)
+    assert_array_equal(other.data, ccd_data.data - 2)
+    # A new master with the same id must not hit the cache
+    del master
+    master = CCDData(np.full(ccd_data.shape, 4.), unit=u.adu)
+    third = subtract_dark(ccd_data, master, data_exposure=30 * u.second,
+                          **kwargs)
+    assert_array_equal(third.data, ccd_data.data - 2)
+
 
 def test_unit_mismatch_behaves_as_expected(ccd_data):
     """
@@ -1003,3 +1165,53 @@ def test_ccd_process_gain_corrected():
     assert(occd.unit == u.electron)
     # Make sure the original keyword is still present. Regression test for #401
     assert occd.meta['testkw'] == 100
+
+
+@pytest.mark.parametrize('gain_corrected', [True, False])
+def test_ccd_process_lazy_uncertainty(gain_corrected):
+    with NumpyRNGContext(345):
+        ccd_data = CCDData(np.random.uniform(100, 300, (50, 60)), unit=u.adu)
+        ccd_data.data[:, -10:] = np.random.normal(100, 1, (50, 10))
+        ccd_data.meta['exptime'] = 120.
+        cal_unit = u.electron if gain_corrected else u.adu
+        calibrations = []
+        for low, high, scale in [(0, 2, 1), (0, 2, 1), (0.5, 1.5, 0.1)]:
+            cal = CCDData(np.random.uniform(low, high, (50, 50)),
+                          unit=cal_unit)
+            cal.uncertainty = np.random.uniform(0.01, scale, (50, 50))
+            calibrations.append(cal)
+    master_bias, dark_frame, master_flat = calibrations
+    dark_frame.meta['exptime'] = 60.
+    kwargs = dict(oscan='[51:60,1:50]', trim='[1:50,1:50]', error=True,
+                  master_bias=master_bias, dark_frame=dark_frame,
+                  master_flat=master_flat, gain=1.7 * u.electron / u.adu,
+                  readnoise=4 * u.electron, exposure_key='exptime',
+                  exposure_unit=u.s, dark_scale=True, min_value=0.7,
+                  gain_corrected=gain_corrected)
+    expected = ccd_process(ccd_data, **kwargs)
+    occd = ccd_process(ccd_data, lazy_uncertainty=True, **kwargs)
+    assert type(occd.uncertainty) is StdDevUncertainty
+    np.testing.assert_allclose(occd.uncertainty.array,
+                               expected.uncertainty.array)
+    occd = ccd_process(ccd_data, lazy_uncertainty=True,
+                       defer_uncertainty=True, **kwargs)
+    assert isinstance(occd.uncertainty, NoiseModelUncertainty)
+    # Nothing is computed until the uncertainty is used
+    assert occd.uncertainty.model is not None
+    assert_array_equal(occd.data, expected.data)
+    np.testing.assert_allclose(occd.uncertainty.array,
+                               expected.uncertainty.array)
+    assert occd.uncertainty.model is None
+    # The calibration frames keep their uncertainty
+    assert master_bias.uncertainty is not None
+
+
+def test_ccd_process_defer_uncertainty_requires_lazy(ccd_data):
+    with pytest.raises(ValueError):
+        ccd_process(ccd_data, defer_uncertainty=True)
+
+
+def test_ccd_process_lazy_uncertainty_without_noise(ccd_data):
+    occd = ccd_process(ccd_data, gain=2 * u.electron / u.adu,
+                       lazy_uncertainty=True)
+    assert occd.uncertainty is None
@@ -5,14 +5,21 @@ from __future__ import (absolute_import, division, print_function,
 
 import numpy as np
 
-from numpy.testing import assert_allclose
+from numpy.testing import assert_allclose, assert_array_equal
+from scipy import ndimage
 import pytest
 from astropy.utils import NumpyRNGContext
+import astropy.units as u
+from astropy.io import fits
 from astropy.nddata import StdDevUncertainty
 
 
-from ..core import (cosmicray_lacosmic, cosmicray_median,
-                    background_deviation_box, background_deviation_filter)
+from ..ccddata import CCDData
+from .. import core
+from ..core import (cosmicray_lacosmic, cosmicray_lacosmic_batch,
+                    cosmicray_median, background_deviation_box,
+                    background_deviation_filter, sigma_func,
+                    _lacosmic_psf_kernel)
 
 DATA_SCALE = 5.3
 NCRAYS = 30
@@ -58,6 +65,149 @@ def test_cosmicray_lacosmic_ccddata(ccd_data):
     # assert nccd_data.mask.sum() == NCRAYS
 
 
+@pytest.mark.parametrize('n_threads', [1, 2])
+def test_cosmicray_lacosmic_tiles(n_threads):
+    # 4 x 4 tiles with cosmic rays on both sides of the seams at 40, 80 and
+    # 120, some of them two pixels wide across a seam.
+    with NumpyRNGContext(123):
+        data = np.random.normal(100, DATA_SCALE, (160, 160))
+    crrays = []
+    for i, y in enumerate([39, 40, 79, 80, 119, 120]):
+        for j, x in enumerate([10, 39, 40, 80, 121, 150]):
+            if (i + j) % 2 == 0:
+                crrays.extend([(y, x), (x, y), (y, x + 1)])
+    crrays = tuple(np.transpose(crrays))
+    data[crrays] = 300
+    mask = np.zeros(data.shape, dtype=bool)
+    mask[70:90, 30:50] = True
+    ccd_data = CCDData(data, unit=u.adu, mask=mask)
+    expected = cosmicray_lacosmic(ccd_data, sigclip=5, niter=2)
+    assert expected.mask[crrays][~mask[crrays]].all()
+    nccd = cosmicray_lacosmic(ccd_data, sigclip=5, niter=2,
+                              tile_shape=(40, 40), tile_halo=12,
+                              n_threads=n_threads)
+    assert_array_equal(nccd.mask, expected.mask)
+    assert_array_equal(nccd.data, expected.data)
+
+
+@pytest.mark.parametrize('n_processes', [1, 2])
+@pytest.mark.data_scale(DATA_SCALE)
+def test_cosmicray_lacosmic_batch(ccd_data, tmpdir, n_processes):
+    add_cosmicrays(ccd_data, DATA_SCALE, 5, ncrays=NCRAYS)
+    ccd_data.mask = np.zeros(ccd_data.shape, dtype=bool)
+    ccd_data.mask[:2] = True
+    filename = tmpdir.join('ccd.fits').strpath
+    ccd_data.write(filename)
+    kwargs = dict(sigclip=5, fsmode='convolve', psfmodel='moffat')
+    expected_data, expected_mask = cosmicray_lacosmic(ccd_data.data,
+                                                      **kwargs)
+    expected = cosmicray_lacosmic(ccd_data, **kwargs)
+
+    results = cosmicray_lacosmic_batch(
+        [ccd_data.data, ccd_data, filename], n_processes=n_processes,
+        ccd_kwargs={'unit': ccd_data.unit}, **kwargs)
+    assert len(results) == 3
+    data, mask = results[0]
+    assert_allclose(data, expected_data)
+    assert_array_equal(mask, expected_mask)
+    for nccd in results[1:]:
+        assert isinstance(nccd, CCDData)
+        assert nccd.unit == ccd_data.unit
+        assert_allclose(nccd.data, expected.data)
+        assert_array_equal(nccd.mask, expected.mask)
+        assert nccd.mask[:2].all()
+
+
+@pytest.mark.parametrize('n_processes', [1, 2])
+@pytest.mark.data_scale(DATA_SCALE)
+def test_cosmicray_lacosmic_batch_file_with_extension(ccd_data, tmpdir,
+                                                      n_processes):
+    add_cosmicrays(ccd_data, DATA_SCALE, 5, ncrays=NCRAYS)
+    ccd_data.uncertainty = np.full(ccd_data.shape, DATA_SCALE)
+    # The image is in the first extension, after an empty primary HDU
+    hdus = ccd_data.to_hdu()
+    hdus.insert(1, fits.ImageHDU(hdus[0].data, hdus[0].header))
+    hdus[0] = fits.PrimaryHDU()
+    filename = tmpdir.join('ccd.fits').strpath
+    hdus.writeto(filename)
+    expected = cosmicray_lacosmic(ccd_data, sigclip=5)
+
+    results = cosmicray_lacosmic_batch(
+        [filename, filename], n_processes=n_processes,
+        ccd_kwargs={'unit': ccd_data.unit}, sigclip=5)
+    for nccd in results:
+        assert nccd.shape == ccd_data.shape
+        assert_allclose(nccd.data, expected.data)
+        assert_array_equal(nccd.mask, expected.mask)
+        assert isinstance(nccd.uncertainty, StdDevUncertainty)
+        assert_allclose(nccd.uncertainty.array, DATA_SCALE)
+
+
+def test_cosmicray_lacosmic_batch_reuses_buffers(monkeypatch):
+    # More images than processes, of different shapes and with and without
+    # masks, so the shared buffers are used for several images.
+    ccds = []
+    with NumpyRNGContext(123):
+        for index, shape in enumerate([(60, 60), (40, 50), (60, 60),
+                                       (30, 30), (50, 40)]):
+            data = np.random.normal(100, DATA_SCALE, shape)
+            data[10, 10:12] = 300
+            mask = None
+            if index % 3 == 0:
+                mask = np.zeros(shape, dtype=bool)
+                mask[:5] = True
+            ccds.append(CCDData(data, unit=u.adu, mask=mask))
+    ccds.append(ccds[1].data)
+    expected = cosmicray_lacosmic_batch(ccds, sigclip=5)
+
+    allocated = []
+    raw_array = core.sharedctypes.RawArray
+
+    def counting_raw_array(typecode, size):
+        allocated.append(size)
+        return raw_array(typecode, size)
+
+    monkeypatch.setattr(core.sharedctypes, 'RawArray', counting_raw_array)
+    results = cosmicray_lacosmic_batch(ccds, n_processes=2, sigclip=5)
+    # One data and one mask buffer per process
+    assert allocated == [60 * 60] * 4
+    for result, expected_result in zip(results[:-1], expected[:-1]):
+        assert_array_equal(result.data, expected_result.data)
+        assert_array_equal(result.mask, expected_result.mask)
+    assert_array_equal(results[-1][0], expected[-1][0])
+    assert_array_equal(results[-1][1], expected[-1][1])
+
+
+def test_cosmicray_lacosmic_batch_check_data():
+    with pytest.raises(TypeError):
+        cosmicray_lacosmic_batch([10])
+
+
+@pytest.mark.parametrize('psfmodel', ['gauss', 'gaussx', 'gaussy', 'moffat'])
+def test_lacosmic_psf_kernel(psfmodel):
+    kernel = _lacosmic_psf_kernel(psfmodel, 2.5, 7, 4.765)
+    assert kernel.shape == (7, 7)
+    assert kernel.dtype == np.float32
+    assert_allclose(kernel.sum(), 1, rtol=1e-6)
+    assert kernel[3, 3] == kernel.max()
+    assert_allclose(kernel, kernel[::-1, ::-1])
+    if psfmodel == 'gaussx':
+        assert_allclose(kernel, kernel[:1].repeat(7, axis=0))
+    if psfmodel == 'gaussy':
+        assert_allclose(kernel, kernel[:, :1].repeat(7, axis=1))
+    # half maximum at half the FWHM from the center
+    if psfmodel in ('gauss', 'moffat'):
+        profile = kernel[3] / kernel[3, 3]
+        assert profile[2] > 0.5 > profile[1]
+
+
+def test_lacosmic_psf_kernel_bad_input():
+    with pytest.raises(ValueError):
+        _lacosmic_psf_kernel('gauss', 2.5, 6, 4.765)
+    with pytest.raises(ValueError):
+        _lacosmic_psf_kernel('lorentz', 2.5, 7, 4.765)
+
+
 @pytest.mark.data_scale(DATA_SCALE)
 def test_cosmicray_lacosmic_check_data(ccd_data):
     with pytest.raises(TypeError):
@@ -95,6 +245,27 @@ def test_cosmicray_median_ccddata(ccd_data):
     assert nccd.mask.sum() == NCRAYS
 
 
+@pytest.mark.data_scale(DATA_SCALE)
+def test_cosmicray_median_ccddata_shares_planes(ccd_data):
+    add_cosmicrays(ccd_data, DATA_SCALE, 5, ncrays=NCRAYS)
+    ccd_data.uncertainty = ccd_data.data * 0.0 + DATA_SCALE
+    ccd_data.mask = np.zeros(ccd_data.shape, dtype=bool)
+    ccd_data.mask[0] = True
+    ccd_data.meta['testkw'] = 1
+    original_data = ccd_data.data.copy()
+    _, crarr = cosmicray_median(ccd_data.data, thresh=5, mbox=11,
+                                error_image=DATA_SCALE)
+    nccd = cosmicray_median(ccd_data, thresh=5, mbox=11)
+    assert np.shares_memory(nccd.uncertainty.array,
+                            ccd_data.uncertainty.array)
+    assert nccd.mask.dtype == bool
+    assert_array_equal(nccd.mask, crarr | ccd_data.mask)
+    assert ccd_data.mask.sum() == ccd_data.shape[1]
+    assert_array_equal(ccd_data.data, original_data)
+    nccd.meta['testkw'] = 2
+    assert ccd_data.meta['testkw'] == 1
+
+
 @pytest.mark.data_scale(DATA_SCALE)
 def test_cosmicray_median_masked(ccd_data):
     threshold = 5
@@ -143,6 +314,50 @@ def test_cosmicray_median_rbox(ccd_data):
     assert crarr.sum() > NCRAYS
 
 
+@pytest.mark.data_scale(DATA_SCALE)
+@pytest.mark.parametrize('tile_shape,n_threads', [
+                         ((30, 40), 1),
+                         (None, 3),
+                         (16, 2)])
+def test_cosmicray_median_tiles(ccd_data, tile_shape, n_threads):
+    threshold = 5
+    add_cosmicrays(ccd_data, DATA_SCALE, threshold, ncrays=NCRAYS)
+    expected = cosmicray_median(ccd_data.data, thresh=5, mbox=11, rbox=5,
+                                error_image=DATA_SCALE)
+    result = cosmicray_median(ccd_data.data, thresh=5, mbox=11, rbox=5,
+                              error_image=DATA_SCALE, tile_shape=tile_shape,
+                              n_threads=n_threads)
+    # The tiling does not change the result
+    assert_array_equal(result[0], expected[0])
+    assert_array_equal(result[1], expected[1])
+
+
+def test_cosmicray_median_median_method():
+    with NumpyRNGContext(125):
+        data = np.random.poisson(100, size=(50, 60))
+    data[10, 10] = 1000
+    expected = cosmicray_median(data, thresh=5, mbox=11, error_image=10.,
+                                median_method='ndimage')
+    result = cosmicray_median(data, thresh=5, mbox=11, error_image=10.,
+                              median_method='histogram')
+    assert_array_equal(result[1], expected[1])
+    assert result[1].sum() == 1
+
+
+@pytest.mark.parametrize('rbox', [4, 5])
+def test_cosmicray_median_replacement(rbox):
+    with NumpyRNGContext(125):
+        data = np.random.normal(size=(50, 60))
+    data[10, 10] = data[0, 59] = data[49, 0] = 100
+    ndata, crarr = cosmicray_median(data, thresh=5, mbox=11, rbox=rbox,
+                                    error_image=1.)
+    assert crarr.sum() == 3
+    # The replacement is the median of the box around each cosmic ray
+    assert_array_equal(ndata[crarr],
+                       ndimage.median_filter(data, rbox)[crarr])
+    assert_array_equal(ndata[~crarr], data[~crarr])
+
+
 @pytest.mark.data_scale(DATA_SCALE)
 def test_cosmicray_median_background_deviation(ccd_data):
     with pytest.raises(TypeError):
@@ -158,6 +373,61 @@ def test_background_deviation_box():
     assert abs(bd.mean() - scale) < 0.10
 
 
+@pytest.mark.parametrize('shape', [(100, 100), (90, 110)])
+def test_background_deviation_box_blocks(shape):
+    with NumpyRNGContext(123):
+        cd = np.random.normal(loc=0, size=shape, scale=5.3)
+    bbox = 25
+    bd = background_deviation_box(cd, bbox)
+    assert bd.shape == cd.shape
+    # Every box, including the smaller ones at the edges, has the deviation
+    # of its pixels
+    for y in range(0, shape[0], bbox):
+        for x in range(0, shape[1], bbox):
+            box = (slice(y, y + bbox), slice(x, x + bbox))
+            assert_allclose(bd[box], sigma_func(cd[box]))
+
+
+def test_background_deviation_box_masked():
+    with NumpyRNGContext(123):
+        cd = np.random.normal(loc=0, size=(100, 100), scale=5.3)
+    cd = np.ma.masked_array(cd, np.zeros(cd.shape, dtype=bool))
+    cd[0:5, 0:5] = 1e6
+    cd.mask[0:5, 0:5] = True
+    cd.mask[50:75, 50:75] = True
+    bd = background_deviation_box(cd, 25)
+    assert isinstance(bd, np.ma.MaskedArray)
+    assert_array_equal(bd.mask, cd.mask)
+    assert_allclose(bd.data[0, 0], sigma_func(cd[0:25, 0:25].compressed()))
+    # A fully masked box gets the deviation of the whole image
+    assert_allclose(bd.data[60, 60], cd.std())
+
+
+def test_background_deviation_box_nan():
+    with NumpyRNGContext(123):
+        cd = np.random.normal(loc=0, size=(100, 100), scale=5.3)
+    cd[50:75, 50:75] = np.nan
+    cd[0, 0] = np.nan
+    bd = background_deviation_box(cd, 25)
+    assert_allclose(bd[0, 0], sigma_func(cd[0:25, 0:25].ravel()[1:]))
+    # A box of NaN gets the deviation of the other pixels of the image
+    assert_allclose(bd[60, 60], np.nanstd(cd))
+    assert not np.isnan(bd).any()
+
+
+def test_background_deviation_box_interpolate():
+    with NumpyRNGContext(123):
+        cd = np.random.normal(loc=0, size=(100, 100), scale=5.3)
+    cd[:, 50:] *= 2
+    bd = background_deviation_box(cd, 25)
+    bd_interpolated = background_deviation_box(cd, 25, interpolate=True)
+    # Same values at the box centers, smooth in between
+    assert_allclose(bd_interpolated[12, 12], bd[12, 12])
+    assert_allclose(bd_interpolated[12, 37], bd[12, 37])
+    assert bd[12, 37] < bd_interpolated[12, 50] < bd[12, 62]
+    assert abs(bd_interpolated[:, :25].mean() - 5.3) < 0.2
+
+
 def test_background_deviation_box_fail():
     with NumpyRNGContext(123):
         scale = 5.3
@@ -174,9 +444,29 @@ def test_background_deviation_filter():
     assert abs(bd.mean() - scale) < 0.10
 
 
+@pytest.mark.parametrize('method', ['fast', 'percentile'])
+def test_background_deviation_filter_matches_exact(method):
+    # The fast methods approximate the MAD of each box; for normally
+    # distributed noise they agree with the exact result within a percent
+    # on average, while single pixels differ by up to about 30 percent.
+    with NumpyRNGContext(123):
+        cd = np.random.normal(loc=0, size=(60, 60), scale=5.3)
+    exact = background_deviation_filter(cd, 11)
+    assert_array_equal(exact,
+                       background_deviation_filter(cd, 11, method='exact'))
+    bd = background_deviation_filter(cd, 11, method=method)
+    relative_difference = np.abs(bd / exact - 1)
+    assert abs((bd / exact - 1).mean()) < 0.01
+    assert np.median(relative_difference) < 0.04
+    assert np.percentile(relative_difference, 99) < 0.2
+    assert relative_difference.max() < 0.3
+
+
 def test_background_deviation_filter_fail():
     with NumpyRNGContext(123):
         scale = 5.3
         cd = np.random.normal(loc=0, size=(100, 100), scale=scale)
     with pytest.raises(ValueError):
         background_deviation_filter(cd, 0.5)
+    with pytest.raises(ValueError):
+        background_deviation_filter(cd, 25, method='mean')
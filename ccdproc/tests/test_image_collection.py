@@ -3,11 +3,15 @@
 from __future__ import (print_function, division, absolute_import,
                         unicode_literals)
 
+import datetime
 import os
+import sqlite3
 from shutil import rmtree
 from tempfile import mkdtemp
 from glob import iglob
+from multiprocessing.pool import ThreadPool
 import sys
+import threading
 import logging
 import pytest
 
@@ -21,7 +25,8 @@ from astropy.extern import six
 
 from ccdproc import CCDData
 
-from ..image_collection import ImageFileCollection
+from ..image_collection import (ImageFileCollection, OneOf, Range, Regex,
+                                _read_header_keywords)
 
 _filters = []
 _original_dir = ''
@@ -45,6 +50,155 @@ def test_fits_summary(triage_setup):
     assert summary['filter'][no_filter_no_object_row].mask
 
 
+def test_fits_summary_n_threads(triage_setup):
+    progress = []
+    ic = ImageFileCollection(triage_setup.test_dir)
+    ic_threads = ImageFileCollection(
+        triage_setup.test_dir, n_threads=3,
+        progress=lambda n_read, n_files: progress.append((n_read, n_files)))
+    assert ic_threads.summary.colnames == ic.summary.colnames
+    for column in ic.summary.colnames:
+        assert np.all(ic_threads.summary[column] == ic.summary[column])
+        assert np.all(ic_threads.summary[column].mask ==
+                      ic.summary[column].mask)
+    n_files = len(ic.files)
+    assert progress == [(n, n_files) for n in range(1, n_files + 1)]
+
+
+def test_fits_summary_index_file(triage_setup, tmpdir, monkeypatch):
+    index_file = tmpdir.join('index.sqlite').strpath
+    ic = ImageFileCollection(triage_setup.test_dir)
+    ic_index = ImageFileCollection(triage_setup.test_dir,
+                                   index_file=index_file)
+
+    read_files = []
+    getheader = fits.getheader
+
+    def counting_getheader(filename, *args, **kwargs):
+        read_files.append(os.path.basename(filename))
+        return getheader(filename, *args, **kwargs)
+
+    monkeypatch.setattr(fits, 'getheader', counting_getheader)
+    ic_cached = ImageFileCollection(triage_setup.test_dir,
+                                    index_file=index_file)
+    assert read_files == []
+    for collection in [ic_index, ic_cached]:
+        assert collection.summary.colnames == ic.summary.colnames
+        for column in ic.summary.colnames:
+            assert np.all(collection.summary[column] == ic.summary[column])
+            assert np.all(collection.summary[column].mask ==
+                          ic.summary[column].mask)
+
+    # Only files that changed are read again
+    del read_files[:]
+    changed = ic.files[0]
+    changed_path = os.path.join(triage_setup.test_dir, changed)
+    hdul = fits.open(changed_path)
+    hdul[0].header['indexed'] = 'changed'
+    hdul.writeto(changed_path, **{'clobber' if _ASTROPY_LT_1_3 else
+                                  'overwrite': True})
+    hdul.close()
+    # Make sure the modification time differs on file systems with a coarse
+    # time resolution
+    mtime = os.stat(changed_path).st_mtime + 10
+    os.utime(changed_path, (mtime, mtime))
+    ic_cached.refresh()
+    assert read_files == [changed]
+    assert ic_cached.summary['indexed'][0] == 'changed'
+
+
+def test_fits_summary_index_file_paths(triage_setup, tmpdir, monkeypatch):
+    index_file = tmpdir.join('index.sqlite').strpath
+    ImageFileCollection(triage_setup.test_dir, index_file=index_file)
+
+    read_files = []
+    getheader = fits.getheader
+
+    def counting_getheader(filename, *args, **kwargs):
+        read_files.append(os.path.basename(filename))
+        return getheader(filename, *args, **kwargs)
+
+    monkeypatch.setattr(fits, 'getheader', counting_getheader)
+    # The same directory through a relative path uses the index
+    parent, directory = os.path.split(os.path.abspath(triage_setup.test_dir))
+    monkeypatch.chdir(parent)
+    ic = ImageFileCollection(directory, index_file=index_file)
+    assert read_files == []
+
+    # Deleted files are removed from the index
+    removed = ic.files[0]
+    os.remove(os.path.join(triage_setup.test_dir, removed))
+    ic.refresh()
+    assert removed not in ic.files
+    connection = sqlite3.connect(index_file)
+    paths = [os.path.basename(row[0]) for row in
+             connection.execute('SELECT path FROM headers')]
+    connection.close()
+    assert sorted(paths) == sorted(ic.files)
+
+
+@pytest.mark.parametrize('ext', [0, 1])
+@pytest.mark.parametrize('compressed', [False, True])
+def test_read_header_keywords(tmpdir, ext, compressed):
+    header = fits.Header()
+    header['strval'] = "O'Brien  "
+    header['lead'] = '  leading'
+    header['empty'] = ''
+    header['intval'] = -42
+    header['fltval'] = 1.5e-3
+    header['bigflt'] = 2e30
+    header['yes'] = True
+    header['no'] = False
+    header['longstr'] = 'x' * 100
+    header['cplx'] = 1 + 2j
+    # Older astropy writes an empty string for None, so give the raw card
+    header.append(fits.Card.fromstring('UNDEF   =' + ' ' * 70))
+    header['dup'] = 1
+    header.append(('dup', 2))
+    hdul = fits.HDUList([fits.PrimaryHDU(np.zeros((5, 7)), header=header),
+                         fits.ImageHDU(np.zeros((3, 2)), header=header)])
+    file_path = tmpdir.join('header.fits' + ('.gz' if compressed else ''))
+    file_path = file_path.strpath
+    hdul.writeto(file_path)
+    full_header = fits.getheader(file_path, ext)
+
+    simple = ['strval', 'lead', 'empty', 'intval', 'fltval', 'bigflt', 'yes',
+              'no', 'naxis1', 'notthere']
+    cards = _read_header_keywords(file_path, ext, simple)
+    assert [k for k, _ in cards] == [k.upper() for k in full_header
+                                     if k.lower() in simple]
+    for keyword, value in cards:
+        assert value == full_header[keyword]
+        if not isinstance(value, six.string_types):
+            assert type(value) is type(full_header[keyword])
+
+    # Values that need the full parser
+    for keyword in ['longstr', 'cplx', 'undef', 'dup']:
+        assert _read_header_keywords(file_path, ext, [keyword]) is None
+    assert _read_header_keywords(file_path, 'PRIMARY', ['intval']) is None
+
+
+def test_read_header_keywords_compressed_image(tmpdir):
+    hdul = fits.HDUList([fits.PrimaryHDU(),
+                         fits.CompImageHDU(np.zeros((30, 40),
+                                                    dtype=np.float32))])
+    file_path = tmpdir.join('compressed.fits').strpath
+    hdul.writeto(file_path)
+    # The raw header is the one of the table holding the compressed tiles
+    assert _read_header_keywords(file_path, 1, ['naxis1', 'bitpix']) is None
+    ic = ImageFileCollection(tmpdir.strpath, keywords=['naxis1', 'bitpix'],
+                             ext=1)
+    assert list(ic.summary['naxis1']) == [40]
+    assert list(ic.summary['bitpix']) == [-32]
+
+
+def test_read_header_keywords_not_fits(tmpdir):
+    file_path = tmpdir.join('not_fits.fits').strpath
+    with open(file_path, 'wb') as f:
+        f.write(b'x' * 2880 * 2)
+    assert _read_header_keywords(file_path, 0, ['naxis']) is None
+
+
 class TestImageFileCollectionRepresentation(object):
     def test_repr_location(self, triage_setup):
         ic = ImageFileCollection(location=triage_setup.test_dir)
@@ -95,6 +249,12 @@ class TestImageFileCollectionRepresentation(object):
                .format(triage_setup.test_dir, 'u' if six.PY2 else ''))
         assert repr(ic) == ref
 
+    def test_repr_n_threads(self, triage_setup):
+        ic = ImageFileCollection(location=triage_setup.test_dir, n_threads=4)
+        ref = ("ImageFileCollection(location={0!r}, n_threads=4)"
+               .format(triage_setup.test_dir))
+        assert repr(ic) == ref
+
     def test_repr_info(self, triage_setup):
         summary_file_path = os.path.join(triage_setup.test_dir, 'info.csv')
         ic = ImageFileCollection(
@@ -560,6 +720,16 @@ class TestImageFileCollection(object):
         assert ic.summary['filter'].dtype == np.dtype('O')
         os.remove(path_bad)
 
+    def test_summary_columns_are_typed(self, triage_setup):
+        ic = ImageFileCollection(triage_setup.test_dir,
+                                 keywords=['filter', 'naxis', 'imagetyp'])
+        # The bias files have no filter; the column is still a string column
+        assert ic.summary['filter'].dtype.kind in 'SU'
+        assert ic.summary['naxis'].dtype.kind == 'i'
+        no_filter = np.array(['no_filter' in f for f in ic.summary['file']])
+        assert np.all(ic.summary['filter'].mask == no_filter)
+        assert not ic.summary['imagetyp'].mask.any()
+
     def test_filter_by_numerical_value(self, triage_setup):
         ic = ImageFileCollection(triage_setup.test_dir, keywords=['naxis'])
         should_be_zero = ic.files_filtered(naxis=2)
@@ -567,6 +737,207 @@ class TestImageFileCollection(object):
         should_not_be_zero = ic.files_filtered(naxis=1)
         assert len(should_not_be_zero) == triage_setup.n_test['files']
 
+    def test_filter_after_changing_summary(self, triage_setup):
+        ic = ImageFileCollection(triage_setup.test_dir,
+                                 keywords=['imagetyp', 'exposure'])
+        biases = sorted(ic.files_filtered(imagetyp='bias'))
+        exposures = ic.files_filtered(exposure=Range(None, 1000))
+        index = list(ic.summary['imagetyp']).index('LIGHT')
+        file_name = ic.summary['file'][index]
+        # Values changed in place are used by the next filter
+        ic.summary['imagetyp'][index] = 'bias'
+        assert (sorted(ic.files_filtered(imagetyp='bias')) ==
+                sorted(biases + [file_name]))
+        ic.summary['exposure'][index] = 5000.
+        assert (sorted(ic.files_filtered(exposure=Range(None, 1000))) ==
+                sorted(set(exposures) - set([file_name])))
+
+    def test_filter_reads_new_keywords_once(self, triage_setup, monkeypatch):
+        ic = ImageFileCollection(triage_setup.test_dir, keywords=['naxis'])
+        read_headers = []
+        original_read_headers = ic._read_headers
+
+        def counting_read_headers(file_paths, keywords=None):
+            read_headers.append(keywords)
+            return original_read_headers(file_paths, keywords=keywords)
+
+        monkeypatch.setattr(ic, '_read_headers', counting_read_headers)
+        biases = ic.files_filtered(imagetyp='BIAS')
+        assert len(biases) == triage_setup.n_test['bias']
+        assert 'imagetyp' in ic.keywords
+        assert list(ic.files_filtered(imagetyp='bias')) == list(biases)
+        assert len(read_headers) == 1
+
+        # The index follows the summary when it is sorted
+        ic.sort(['imagetyp'])
+        assert (sorted(ic.files_filtered(imagetyp='bias')) ==
+                sorted(biases))
+        assert not ic.summary['file'].mask.any()
+
+    def test_filter_with_predicates(self, tmpdir):
+        images = [('a.fits', 'M13', 10, '2018-01-01T22:10:00'),
+                  ('b.fits', 'm 92', 30, '2018-01-02T03:00:00.5'),
+                  ('c.fits', 'M13 focus', 60.5, '2018-01-02T21:00:00'),
+                  ('d.fits', 'flat', 5, 'not a date'),
+                  ('e.fits', None, None, None)]
+        for name, obj, exptime, date in images:
+            hdu = fits.PrimaryHDU(np.zeros((2, 2)))
+            for key, value in [('object', obj), ('exptime', exptime),
+                               ('date-obs', date)]:
+                if value is not None:
+                    hdu.header[key] = value
+            hdu.writeto(tmpdir.join(name).strpath)
+        ic = ImageFileCollection(tmpdir.strpath,
+                                 keywords=['object', 'exptime', 'date-obs'])
+
+        def filtered(**kwd):
+            return sorted(ic.files_filtered(**kwd))
+
+        assert filtered(exptime=Range(10, 30)) == ['a.fits', 'b.fits']
+        assert filtered(exptime=Range(low=30)) == ['b.fits', 'c.fits']
+        assert filtered(exptime=~Range(10, 30)) == ['c.fits', 'd.fits']
+        night = Range('2018-01-01T12:00', datetime.datetime(2018, 1, 2, 12))
+        assert filtered(**{'date-obs': night}) == ['a.fits', 'b.fits']
+        assert filtered(object=OneOf('m13', 'FLAT')) == ['a.fits', 'd.fits']
+        assert filtered(object=Regex(r'^m ?(13|92)')) == ['a.fits', 'b.fits',
+                                                          'c.fits']
+        assert (filtered(object=Regex('^m') & ~Regex('focus'),
+                         exptime=Range(high=20) | 30) ==
+                ['a.fits', 'b.fits'])
+        assert filtered(object=Regex('.'), exptime=None) == []
+        # Strings and dates are not numbers and numbers are not dates
+        assert filtered(object=Range(0, 100)) == []
+        assert filtered(exptime=Range('2000-01-01')) == []
+
+    def test_range_bounds_must_have_same_type(self):
+        with pytest.raises(TypeError):
+            Range(1, '2018-01-01')
+        with pytest.raises(ValueError):
+            Range('yesterday')
+
+    def test_filter_returns_view(self, triage_setup):
+        ic = ImageFileCollection(triage_setup.test_dir,
+                                 keywords=['imagetyp', 'filter'])
+        lights = ic.filter(imagetyp='light')
+        assert len(lights.files) == triage_setup.n_test['light']
+        assert list(lights.summary['file']) == lights.files
+        assert lights._summary is ic.summary
+        assert (sorted(lights.files_filtered(filter='R')) ==
+                sorted(ic.files_filtered(imagetyp='light', filter='R')))
+        # Filtering a view again and filtering on a new keyword
+        objects = lights.filter(object='*')
+        assert (sorted(objects.files) ==
+                sorted(ic.files_filtered(imagetyp='light', object='*')))
+        assert 'object' in ic.keywords
+
+        # Sorting either collection does not change the other
+        ic.sort(['file'])
+        lights.sort(['file'])
+        assert lights.files == sorted(lights.files)
+        assert (sorted(lights.files) ==
+                sorted(ic.files_filtered(imagetyp='light')))
+        assert len(ic.files) == triage_setup.n_test['files']
+
+        for header, file_name in lights.headers(return_fname=True):
+            assert header['imagetyp'].lower() == 'light'
+            # The summary is not changed while iterating
+            assert not ic.summary['file'].mask.any()
+        assert len(list(lights.headers(filter='R'))) == len(
+            lights.files_filtered(filter='R'))
+
+    def test_filter_view_keywords(self, triage_setup):
+        ic = ImageFileCollection(triage_setup.test_dir,
+                                 keywords=['imagetyp', 'filter', 'exposure'])
+        summary = ic.summary
+        lights = ic.filter(imagetyp='light')
+        lights.keywords = ['imagetyp']
+        assert lights.keywords == ['file', 'imagetyp']
+        assert list(lights.summary['file']) == lights.files
+        # The summary of the original collection is unchanged
+        assert ic.summary is summary
+        assert ic.keywords == ['file', 'imagetyp', 'filter', 'exposure']
+        assert len(ic.summary) == triage_setup.n_test['files']
+
+        # Removing columns from the original collection keeps those of the
+        # collections made from it.
+        darks = ic.filter(imagetyp='dark')
+        ic.keywords = ['imagetyp']
+        assert ic.keywords == ['file', 'imagetyp']
+        assert darks.keywords == ['file', 'imagetyp', 'filter', 'exposure']
+        assert len(darks.files_filtered(exposure='*')) == len(darks.files)
+
+    def test_filtered_view_in_threads(self, triage_setup):
+        ic = ImageFileCollection(triage_setup.test_dir)
+        lights = ic.filter(imagetyp='light')
+        expected = sorted(lights.files_filtered(filter='R'))
+
+        def read_headers(_):
+            return sorted(name for _, name in
+                          lights.headers(filter='R', return_fname=True))
+
+        pool = ThreadPool(4)
+        try:
+            results = pool.map(read_headers, range(8))
+        finally:
+            pool.close()
+            pool.join()
+        assert results == [expected] * 8
+
+    @pytest.mark.parametrize('generator', ['headers', 'hdus', 'data',
+                                           'ccds'])
+    def test_generator_prefetch(self, triage_setup, generator):
+        ic = ImageFileCollection(triage_setup.test_dir)
+        kwargs = {'ccd_kwargs': {'unit': 'adu'}} if generator == 'ccds' else {}
+
+        def items(**kwd):
+            kwd.update(kwargs)
+            return [(str(getattr(item, 'header', item)), name) for item, name
+                    in getattr(ic, generator)(return_fname=True, **kwd)]
+
+        assert items(prefetch=3) == items()
+        assert items(prefetch=2, imagetyp='light') == items(imagetyp='light')
+
+    def test_generator_prefetch_stops_threads(self, triage_setup):
+        ic = ImageFileCollection(triage_setup.test_dir)
+        n_threads = threading.active_count()
+        headers = ic.headers(prefetch=2)
+        next(headers)
+        assert threading.active_count() > n_threads
+        headers.close()
+        assert threading.active_count() == n_threads
+
+    def test_generator_lazy(self, triage_setup):
+        ic = ImageFileCollection(triage_setup.test_dir, max_open_files=2)
+        assert 'max_open_files=2' in repr(ic)
+        data = list(ic.data())
+        sections = list(ic.data(lazy=True))
+        assert len(ic._handles._hdulists) <= 2
+        # Sections of files that were closed open them again
+        for section, expected in zip(sections, data):
+            assert section.shape == expected.shape
+            np.testing.assert_array_equal(section[2:5], expected[2:5])
+            np.testing.assert_array_equal(np.asarray(section), expected)
+        for hdu, expected in zip(ic.hdus(lazy=True), data):
+            np.testing.assert_array_equal(hdu.data, expected)
+        ic.close()
+        assert not ic._handles._hdulists
+
+        with pytest.raises(ValueError):
+            next(ic.ccds(lazy=True))
+        with pytest.raises(ValueError):
+            next(ic.data(lazy=True, save_with_name='_new'))
+
+    def test_generator_lazy_scaled_data(self, tmpdir):
+        hdu = fits.PrimaryHDU(np.arange(20, dtype=np.int16).reshape(4, 5))
+        hdu.header['bzero'] = 32768
+        hdu.header['bscale'] = 2
+        hdu.writeto(tmpdir.join('scaled.fits').strpath)
+        ic = ImageFileCollection(tmpdir.strpath)
+        expected = next(ic.data())
+        section = next(ic.data(lazy=True))
+        np.testing.assert_array_equal(section[1:3, 2], expected[1:3, 2])
+        ic.close()
+
     def test_files_filtered_with_full_path(self, triage_setup):
         ic = ImageFileCollection(triage_setup.test_dir, keywords=['naxis'])
         files = ic.files_filtered(naxis=1, include_path=True)
@@ -854,20 +1225,37 @@ class TestImageFileCollection(object):
         for _ in coll.ccds(ccd_kwargs={'unit': 'adu'}):
             pass
 
-    def test_ccds_generator_does_not_support_overwrite(self, triage_setup):
+    @pytest.mark.skipif("os.environ.get('APPVEYOR') or os.sys.platform == 'win32'",
+                        reason="fails on Windows because file "
+                               "overwriting fails")
+    def test_ccds_generator_overwrite(self, triage_setup):
         """
-        CCDData objects have several attributes that make it hard to
-        reliably support overwriting. For example in what extension should
-        mask, uncertainty be written?
-        Also CCDData doesn't explicitly support in-place operations so it's to
-        easy to create a new CCDData object inadvertantly and all modifications
-        might be lost.
+        CCDData objects are written back as they are after the iteration, so
+        changes have to be made in place.
         """
         ic = ImageFileCollection(triage_setup.test_dir)
-        with pytest.raises(NotImplementedError):
-            ic.ccds(overwrite=True)
-        with pytest.raises(NotImplementedError):
-            ic.ccds(clobber=True)
+        for ccd in ic.ccds(ccd_kwargs={'unit': 'adu'}, overwrite=True,
+                           imagetyp='bias', prefetch=2):
+            ccd.data[0] = 7
+            ccd.mask = np.zeros(ccd.shape, dtype=bool)
+            ccd.mask[0] = True
+            ccd.header['written'] = 'yes'
+        for ccd in ic.ccds(ccd_kwargs={'unit': 'adu'}, imagetyp='bias'):
+            assert ccd.data[0] == 7
+            assert ccd.mask[0] and not ccd.mask[1:].any()
+            assert ccd.header['written'] == 'yes'
+
+    def test_generator_save_keeps_other_extensions(self, tmpdir):
+        hdul = fits.HDUList([fits.PrimaryHDU(np.zeros((3, 3))),
+                             fits.ImageHDU(np.ones((2, 2)), name='other')])
+        hdul.writeto(tmpdir.join('two.fits').strpath)
+        destination = tmpdir.mkdir('copies').strpath
+        ic = ImageFileCollection(tmpdir.strpath)
+        for data in ic.data(save_location=destination):
+            data += 5
+        with fits.open(os.path.join(destination, 'two.fits')) as saved:
+            np.testing.assert_array_equal(saved[0].data, 5)
+            np.testing.assert_array_equal(saved['other'].data, 1)
 
     def test_glob_matching(self, triage_setup):
         # We'll create two files with strange names to test glob
@@ -0,0 +1,71 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import copy
+
+import numpy as np
+from numpy.testing import assert_allclose
+
+import astropy.units as u
+from astropy.nddata import StdDevUncertainty
+
+from ..ccddata import CCDData, fits_ccddata_writer
+from ..noise_model import NoiseModel, NoiseModelUncertainty
+
+
+def test_noise_model_evaluate():
+    data = np.full((10, 10), 16.)
+    bias_deviation = np.full((10, 10), 2.)
+    flat = np.full((10, 10), 4.)
+    flat_deviation = np.full((10, 10), 0.2)
+    model = NoiseModel(data.shape)
+    model.set_ccd_noise(data, 4., 0.)
+    model.scale(4.)
+    model.add(bias_deviation, 0.5)
+    model.divide(data * 4, flat, flat_deviation, norm=2.)
+    # ccd noise 64 + bias 1, divided by a normalized flat of 2 with
+    # relative deviation 0.05 on a result of 32
+    expected = np.sqrt(65 / 4 + (32 * 0.05) ** 2)
+    assert_allclose(model.evaluate(), expected)
+    assert model.evaluate(dtype=np.float32).dtype == np.float32
+
+
+def test_noise_model_without_noise():
+    model = NoiseModel((5, 5))
+    model.scale(2.)
+    model.divide(np.ones((5, 5)), np.ones((5, 5)))
+    assert len(model) == 0
+    model.add(np.ones((5, 5)))
+    assert_allclose(model.evaluate(), 1.)
+
+
+def test_noise_model_uncertainty_is_lazy():
+    model = NoiseModel((5, 5))
+    model.set_deviation(np.full((5, 5), 3.))
+    uncertainty = NoiseModelUncertainty(model=model)
+    ccd = CCDData(np.zeros((5, 5)), unit=u.adu, uncertainty=uncertainty)
+    assert ccd.uncertainty.model is not None
+    ccd_copy = ccd.copy()
+    assert ccd_copy.uncertainty.model is not None
+    assert_allclose(ccd_copy.uncertainty.array, 3.)
+    assert_allclose(copy.deepcopy(uncertainty).array, 3.)
+    std_dev = StdDevUncertainty(ccd.uncertainty)
+    assert type(std_dev) is StdDevUncertainty
+    assert_allclose(std_dev.array, 3.)
+    assert ccd.uncertainty.model is None
+
+
+def test_noise_model_uncertainty_write(tmpdir):
+    model = NoiseModel((5, 5))
+    model.set_deviation(np.full((5, 5), 3.))
+    ccd = CCDData(np.zeros((5, 5)), unit=u.adu,
+                  uncertainty=NoiseModelUncertainty(model=model))
+    filename = tmpdir.join('lazy.fits').strpath
+    fits_ccddata_writer(ccd, filename)
+    ccd_disk = CCDData.read(filename)
+    assert isinstance(ccd_disk.uncertainty, StdDevUncertainty)
+    assert_allclose(ccd_disk.uncertainty.array, 3.)
+    # The image written is not changed
+    assert isinstance(ccd.uncertainty, NoiseModelUncertainty)
@@ -4,8 +4,10 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
 import numpy as np
+import pytest
 
 from astropy.nddata import StdDevUncertainty
+from astropy.utils import NumpyRNGContext
 
 from scipy import ndimage
 
@@ -64,3 +66,47 @@ def test_medianfilter_ndarray():
     reference = ndimage.median_filter(arr, 3)
     # It's a wrapped function so we can use the equal comparison.
     np.testing.assert_array_equal(result, reference)
+
+
+@pytest.mark.parametrize('size', [1, 3, 4, (5, 2), 12])
+@pytest.mark.parametrize('dtype', [np.uint8, np.int32, bool])
+def test_medianfilter_histogram(size, dtype):
+    with NumpyRNGContext(123):
+        arr = np.random.randint(0, 20, (9, 11)).astype(dtype)
+    reference = ndimage.median_filter(arr, size)
+    for method in ['histogram', 'auto']:
+        result = core.median_filter(arr, size, method=method)
+        assert result.dtype == arr.dtype
+        np.testing.assert_array_equal(result, reference)
+
+
+def test_medianfilter_separable():
+    with NumpyRNGContext(123):
+        arr = np.random.random((50, 50))
+    result = core.median_filter(arr, size=7, method='separable')
+    reference = ndimage.median_filter(arr, 7)
+    # An approximation, but close for noise
+    assert np.abs(result - reference).mean() < 0.05
+    # Exact for boxes that are one pixel wide
+    np.testing.assert_array_equal(
+        core.median_filter(arr, size=(1, 7), method='separable'),
+        ndimage.median_filter(arr, size=(1, 7)))
+
+
+def test_medianfilter_select_method():
+    assert core._select_median_method(np.zeros((5, 5)), (3, 3)) == 'ndimage'
+    arr = np.arange(100).reshape(10, 10)
+    assert core._select_median_method(arr, (21, 21)) == 'histogram'
+    # In this range the histogram method is often slower
+    assert core._select_median_method(arr, (11, 11)) == 'ndimage'
+    assert core._select_median_method(arr, (3, 3)) == 'ndimage'
+
+
+def test_medianfilter_method_fails():
+    arr = np.ones((5, 5))
+    with pytest.raises(TypeError):
+        core.median_filter(arr, 3, method='histogram')
+    with pytest.raises(TypeError):
+        core.median_filter(arr.astype(int), 3, mode='nearest', method='auto')
+    with pytest.raises(ValueError):
+        core.median_filter(arr, 3, method='mean')
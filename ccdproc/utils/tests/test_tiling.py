@@ -0,0 +1,54 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+
+import numpy as np
+
+import pytest
+
+from ..tiling import iter_tiles, map_tiles
+
+
+@pytest.mark.parametrize('tile_shape,halo', [
+                         ((10, 10), 0),
+                         ((7, 30), 3),
+                         (4, (1, 2)),
+                         ((100, 100), 5)
+                         ])
+def test_iter_tiles_cover_image(tile_shape, halo):
+    shape = (23, 31)
+    counts = np.zeros(shape, dtype=int)
+    image = np.arange(np.prod(shape)).reshape(shape)
+    for tile in iter_tiles(shape, tile_shape, halo):
+        counts[tile.core] += 1
+        # The core is at the inner position of the padded region
+        np.testing.assert_array_equal(image[tile.padded][tile.inner],
+                                      image[tile.core])
+    np.testing.assert_array_equal(counts, 1)
+
+
+def test_iter_tiles_halo():
+    tiles = list(iter_tiles((10, 10), (5, 10), halo=2))
+    assert len(tiles) == 2
+    assert tiles[0].padded == (slice(0, 7), slice(0, 10))
+    assert tiles[1].padded == (slice(3, 10), slice(0, 10))
+    assert tiles[1].inner == (slice(2, 7), slice(0, 10))
+
+
+def test_iter_tiles_fails():
+    with pytest.raises(ValueError):
+        list(iter_tiles((10, 10), (0, 5)))
+    with pytest.raises(ValueError):
+        list(iter_tiles((10, 10), (5, 5, 5)))
+
+
+@pytest.mark.parametrize('n_threads', [1, 3])
+def test_map_tiles(n_threads):
+    shape = (20, 20)
+    result = np.zeros(shape)
+
+    def fill(tile):
+        result[tile.core] = tile.core[0].start
+        return tile.core[1].start
+
+    starts = map_tiles(fill, shape, (5, 10), n_threads=n_threads)
+    assert starts == [0, 10] * 4
+    np.testing.assert_array_equal(result[:, 0], np.repeat([0, 5, 10, 15], 5))
@@ -0,0 +1,135 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+
+"""
+Define utility functions to process images in tiles
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+__all__ = ["Tile", "iter_tiles", "map_tiles"]
+
+
+class Tile(namedtuple('Tile', ['core', 'padded', 'inner'])):
+    """
+    Slices of a tile of an image.
+
+    Attributes
+    ----------
+
+    core : tuple of slice objects
+        Region of the image that the tile covers; the cores of all tiles
+        cover the image without overlapping.
+
+    padded : tuple of slice objects
+        Region of the image covered by the core and its halo, limited to the
+        image.
+
+    inner : tuple of slice objects
+        Position of the core within the padded region.
+    """
+    __slots__ = ()
+
+
+def _per_axis(value, ndim):
+    try:
+        values = tuple(int(v) for v in value)
+    except TypeError:
+        values = (int(value),) * ndim
+    if len(values) != ndim:
+        raise ValueError("need one value for each of the {} axes, got "
+                         "{}.".format(ndim, value))
+    return values
+
+
+def iter_tiles(shape, tile_shape, halo=0):
+    """
+    Split an image into tiles with an overlapping halo.
+
+    Parameters
+    ----------
+
+    shape : tuple of int
+        Shape of the image.
+
+    tile_shape : int or tuple of int
+        Shape of the tiles, without halo. Tiles at the upper edges of the
+        image are smaller if ``shape`` is not a multiple of ``tile_shape``.
+
+    halo : int or tuple of int, optional
+        Number of pixels added on both sides of each tile along each axis,
+        e.g. half the size of a filter, so that filtering the padded region
+        gives the same result in the core as filtering the whole image.
+
+    Yields
+    ------
+
+    tile : `Tile`
+        Slices of the tile, in row-major order.
+    """
+    ndim = len(shape)
+    tile_shape = _per_axis(tile_shape, ndim)
+    halo = _per_axis(halo, ndim)
+    if min(tile_shape) < 1 or min(halo) < 0:
+        raise ValueError("tile_shape must be positive and halo must not be "
+                         "negative.")
+
+    def axis_tiles(length, size, pad):
+        for start in range(0, length, size):
+            stop = min(start + size, length)
+            padded_start = max(start - pad, 0)
+            padded_stop = min(stop + pad, length)
+            yield (slice(start, stop), slice(padded_start, padded_stop),
+                   slice(start - padded_start, stop - padded_start))
+
+    def product(axis):
+        if axis == ndim:
+            yield ()
+            return
+        for axis_tile in axis_tiles(shape[axis], tile_shape[axis],
+                                    halo[axis]):
+            for rest in product(axis + 1):
+                yield (axis_tile,) + rest
+
+    for axis_slices in product(0):
+        core, padded, inner = zip(*axis_slices)
+        yield Tile(core, padded, inner)
+
+
+def map_tiles(func, shape, tile_shape, halo=0, n_threads=1):
+    """
+    Call a function for each tile of an image, optionally in parallel.
+
+    Parameters
+    ----------
+
+    func : callable
+        Function called with the `Tile` of each tile as only argument. With
+        more than one thread it must be thread safe, e.g. only write to the
+        core of the tile in shared output arrays; numpy and scipy release
+        the global interpreter lock in most array operations.
+
+    shape, tile_shape, halo :
+        See `iter_tiles`.
+
+    n_threads : int, optional
+        Number of threads used to process the tiles.
+
+    Returns
+    -------
+
+    results : list
+        Return values of ``func``, in the order of `iter_tiles`.
+    """
+    tiles = list(iter_tiles(shape, tile_shape, halo))
+    if n_threads > 1 and len(tiles) > 1:
+        pool = ThreadPool(min(n_threads, len(tiles)))
+        try:
+            return pool.map(func, tiles)
+        finally:
+            pool.close()
+            pool.join()
+    return [func(tile) for tile in tiles]